@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import path as osp
+from pathlib import Path
+import time
+
+from tqdm import tqdm
+
+from modules.audio import save_audio
+from utils.helpers import exists
+from utils.loggers import get_logger
+
+logger = get_logger("module_log")
+
+ROOT_KEY = "input"
+
+
+class Item:
+    """One unit of work flowing through the dag, either a whole file or one of its chunks.
+
+    `metadata` is the json friendly record returned to the caller while `buffers`
+    holds the live values (paths or in-memory `(wav, sr)` tuples) handed to processors.
+    """
+
+    def __init__(self, name, metadata, parent=None) -> None:
+        self.name = name
+        self.metadata = metadata
+        self.buffers = {}
+        self.parent = parent
+
+    def get(self, key):
+        if key in self.buffers:
+            return self.buffers[key]
+        if key in self.metadata:
+            return self.metadata[key]
+        if exists(self.parent):
+            return self.parent.get(key)
+        raise KeyError(f"'{key}' is not available for {self.name}")
+
+
+class Stage:
+    def __init__(self, proc, previous, in_memory=False) -> None:
+        self.name = proc.name
+        self.output = proc.get("output", self.name)
+        inputs = proc.get("inputs", None)
+        self.inputs = dict(inputs) if exists(inputs) else {"audio": previous or ROOT_KEY}
+        self.split = proc.get("split", "audio_chunks" if self.name == "chunking" else None)
+        args = proc.get("args", None) or {}
+        # Streaming processors read their input block by block and write their outputs as they go
+        self.stream_input = proc.get(
+            "stream_input", args.get("model_choice") == "streaming_chunking" or args.get("streaming", False)
+        )
+        self.persist = proc.get("persist", not in_memory or self.stream_input)
+        self.save_dir = proc.get("save_dir", self.name)
+        self.batch_size = proc.get("batch_size", None)
+        self.audio_format = proc.get("audio_format", "wav")
+        # Paths of queued audio writes do not exist yet, so text outputs are declared instead of guessed
+        self.text_output = proc.get("text_output", self.name == "transcription")
+        self.deps = set()
+        self.level = "file"
+
+
+class DagExecutor:
+    def __init__(self, runner, processors) -> None:
+        self.runner = runner
+        self.stages = []
+        previous = None
+        for proc in processors:
+            stage = Stage(proc, previous, in_memory=runner.in_memory)
+            self.stages.append(stage)
+            previous = stage.output
+        self.waves = self.build(self.stages)
+
+    @staticmethod
+    def build(stages):
+        producers = {}
+        for stage in stages:
+            if stage.output in producers or stage.output == ROOT_KEY:
+                raise ValueError(f"Output key '{stage.output}' of {stage.name} is already in use")
+            producers[stage.output] = stage
+
+        for stage in stages:
+            for key in stage.inputs.values():
+                if key == ROOT_KEY:
+                    continue
+                if key not in producers:
+                    raise ValueError(f"{stage.name} reads '{key}' which no processor produces")
+                stage.deps.add(producers[key].name)
+
+        by_name = {stage.name: stage for stage in stages}
+        waves, done, remaining = [], set(), list(stages)
+        while remaining:
+            wave = [stage for stage in remaining if stage.deps <= done]
+            if not wave:
+                raise ValueError(f"Processors {[s.name for s in remaining]} form a cycle")
+            for stage in wave:
+                parents = [by_name[dep] for dep in stage.deps]
+                if any(exists(parent.split) or parent.level == "chunk" for parent in parents):
+                    stage.level = "chunk"
+                if exists(stage.split) and stage.level == "chunk":
+                    raise ValueError(f"{stage.name} cannot split items that were already split")
+            waves.append(wave)
+            done.update(stage.name for stage in wave)
+            remaining = [stage for stage in remaining if stage.name not in done]
+        return waves
+
+    def stage_kwargs(self, stage, item, save_dir):
+        kwargs = {}
+        from_path = True
+        for kwarg, key in stage.inputs.items():
+            value = item.get(key)
+            if kwarg == "audio" and isinstance(value, tuple):
+                kwargs["audio"], kwargs["sr"] = value
+                from_path = False
+            elif kwarg == "audio":
+                kwargs["audio_path"] = value
+            else:
+                kwargs[kwarg] = value
+        if from_path or exists(stage.split):
+            kwargs.update(save_to_file=stage.persist, save_dir=save_dir)
+        if exists(stage.split):
+            # Chunks of a streamed source are only kept on disk, holding them all would undo the streaming
+            return_audio = self.runner.in_memory and not (stage.stream_input and stage.persist)
+            kwargs.update(return_audio=return_audio, name=item.name, audio_format=stage.audio_format)
+        return kwargs
+
+    def streams_source(self):
+        """Whether every stage reading the source streams it, so it never has to be decoded whole."""
+        readers = [stage for stage in self.stages if ROOT_KEY in stage.inputs.values()]
+        return bool(readers) and all(stage.stream_input for stage in readers)
+
+    def shard_keys(self, file_metadata):
+        """Keys `ShardWriter.write` recorded for the items of a processed file."""
+        split = [stage for stage in self.stages if exists(stage.split)]
+        if not split:
+            return [file_metadata["key"]] if "key" in file_metadata else []
+        return [
+            chunk["key"]
+            for stage in split
+            for chunk in file_metadata[stage.output][stage.split]
+            if "key" in chunk
+        ]
+
+    def store(self, stage, item, output, save_dir):
+        if isinstance(output, tuple):
+            item.buffers[stage.output] = output
+            if stage.persist:
+                Path(save_dir).mkdir(parents=True, exist_ok=True)
+                save_path = osp.join(save_dir, f"{item.name}.{stage.audio_format}")
+                save_audio(output[0], save_path, output[1])
+                output = save_path
+            else:
+                output = None
+        elif stage.text_output and stage.persist and isinstance(output, str):
+            Path(save_dir).mkdir(parents=True, exist_ok=True)
+            with open(osp.join(save_dir, f"{item.name}.txt"), "w", encoding="utf-8") as f:
+                f.write(output)
+        item.metadata[stage.output] = output
+
+    def split(self, stage, item):
+        chunks = []
+        for chunk in item.metadata[stage.output][stage.split]:
+            child = Item(chunk["name"], chunk, parent=item)
+            audio = chunk.pop("audio", None)
+            child.buffers[stage.output] = (
+                (audio, chunk["sample_rate"]) if exists(audio) else chunk["filepath"]
+            )
+            chunks.append(child)
+        return chunks
+
+    def run_stage(self, stage, items, save_dir):
+        logger.info(f"Running pipeline -> {stage.name}")
+        total_time = 0
+        stage_dir = osp.join(save_dir, stage.save_dir)
+        if exists(stage.batch_size) and len(items) > 1:
+            now = time.time()
+            outputs = self.runner.run_dag_batch(
+                stage.name,
+                [self.stage_kwargs(stage, item, stage_dir) for item in items],
+                batch_size=stage.batch_size,
+            )
+            total_time = time.time() - now
+            for item, output in zip(items, outputs):
+                self.store(stage, item, output, stage_dir)
+                item.metadata[f"{stage.output}_proc_time"] = total_time / len(items)
+            return total_time
+
+        for item in tqdm(items, desc=stage.name, disable=len(items) == 1):
+            now = time.time()
+            output = self.runner.run_dag(stage.name, **self.stage_kwargs(stage, item, stage_dir))
+            proc_time = time.time() - now
+            self.store(stage, item, output, stage_dir)
+            item.metadata[f"{stage.output}_proc_time"] = proc_time
+            total_time += proc_time
+        return total_time
+
+    def __call__(self, file_metadata, source, save_dir, name=None):
+        name = name or osp.splitext(osp.basename(source))[0]
+        root = Item(name, file_metadata)
+        root.buffers[ROOT_KEY] = source
+        items = {"file": [root], "chunk": []}
+
+        for wave in self.waves:
+            if len(wave) == 1:
+                times = [self.run_stage(wave[0], items[wave[0].level], save_dir)]
+            else:
+                # Load up front so concurrent branches never race on loading processors
+                self.runner.load_processors([stage.name for stage in wave])
+                # Independent branches only read shared inputs and write their own keys
+                with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+                    times = list(
+                        pool.map(
+                            lambda stage: self.run_stage(stage, items[stage.level], save_dir),
+                            wave,
+                        )
+                    )
+            # Downstream stages may read what this wave persisted, queued writes have to land first
+            self.runner.flush_writes()
+            for stage, total_time in zip(wave, times):
+                file_metadata[f"{stage.name}_proc_time"] = total_time
+                if exists(stage.split):
+                    items["chunk"] = self.split(stage, root)
+                self.runner.cleanup_dag(stage.name)
+
+        split = any(exists(stage.split) for stage in self.stages)
+        self.runner.write_shards(items["chunk"] if split else [root])
+        return file_metadata
@@ -1,24 +1,66 @@
 import os
 import re
+from os import path as osp
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from tqdm import tqdm
 from pytube import YouTube
-import wget
 from urllib.parse import urlparse
 
-from utils.io import load_configs
-from utils.helpers import exists
+from modules.audio import SUPPORTED_EXTENSIONS, SAMPLE_RATE, pipe_to_wav
+from utils.io import load_configs, download_file_from_url, get_session
+from utils.helpers import exists, make_hash
+from utils.loggers import get_logger
 from config import settings
+from .stage_cache import StageCache
+
+logger = get_logger("module_log")
 
 class Downloader:
-    def __init__(self, configs=None, save_dir="data/") -> None:
+    def __init__(
+        self,
+        configs=None,
+        save_dir="data/",
+        num_workers=1,
+        prefetch_size=0,
+        shard=None,
+        resume=False,
+        stream_archives=False,
+        audio_only=False,
+    ) -> None:
         if exists(configs):
             self.configs = load_configs(configs[0])
         else:
             self.configs = None
         self.save_dir = save_dir
+        self.shard = shard
+        self.stream_archives = stream_archives
+        self.audio_only = audio_only
+        self.cache = StageCache(osp.join(settings.CACHE_DIR, "stages", "downloads")) if resume else None
+        self.num_workers = max(1, num_workers)
+        self.prefetch_size = max(prefetch_size, self.num_workers) if self.num_workers > 1 else prefetch_size
+
+    @staticmethod
+    def sanitize_name(name):
+        return re.sub(r"[^a-zA-Z0-9 ]", "", name).replace(" ", "_")
+
+    def download_audio_from_youtube(self, url):
+        yt = YouTube(url)
+        save_dir = os.path.join(self.save_dir, yt.video_id)
+        os.makedirs(save_dir, exist_ok=True)
+        wav_path = os.path.join(save_dir, f"{self.sanitize_name(yt.title) or yt.video_id}.wav")
+        if not osp.isfile(wav_path):
+            # The compressed audio track is piped through ffmpeg as it arrives, never stored as is
+            stream = yt.streams.filter(only_audio=True).order_by("abr").desc().first()
+            pipe_to_wav(stream.stream_to_buffer, wav_path, sr=SAMPLE_RATE, channels=1)
+        metadata = {"video": wav_path, "source": url}
+        return (metadata, True)
+
     def download_from_youtube(self, url):
+        if self.audio_only:
+            return self.download_audio_from_youtube(url)
         yt = YouTube(url)
         stream = yt.streams.get_highest_resolution()
         save_path = os.path.join(self.save_dir, f"{str(uuid4())}")
@@ -26,8 +68,7 @@ class Downloader:
 
         directory, filename = os.path.split(file_path)
         file_root, file_extension = os.path.splitext(filename)
-        sanitized_root = re.sub(r"[^a-zA-Z0-9 ]", "", file_root)
-        sanitized_root = sanitized_root.replace(" ", "_")
+        sanitized_root = self.sanitize_name(file_root)
         
         new_filename = f"{sanitized_root}{file_extension}"
         new_file_path = os.path.join(directory, new_filename)
@@ -36,9 +77,25 @@ class Downloader:
         metadata = {"video": new_file_path, "source": url}
         return (metadata, True)
 
-    def download_from_url(self, url):
-        save_path = os.path.join(self.save_dir, f"{str(uuid4())}.zip")
-        wget.download(url, save_path)
+    @staticmethod
+    def url_to_path(url, save_dir):
+        # Stable per url, so interrupted downloads are resumed and finished ones skipped
+        file_name = osp.basename(urlparse(url).path) or "download.zip"
+        if not osp.splitext(file_name)[-1]:
+            file_name = f"{file_name}.zip"
+        return os.path.join(save_dir, f"{make_hash(url)[:16]}_{file_name}")
+
+    def download_from_url(self, url, save_dir=None, size=None, checksum=None, algorithm="sha256"):
+        save_dir = save_dir or self.save_dir
+        save_path = self.url_to_path(url, save_dir)
+        download_file_from_url(
+            url,
+            save_path,
+            session=get_session(max(self.num_workers, 10)),
+            size=size,
+            checksum=checksum,
+            algorithm=algorithm,
+        )
         metadata = {"file": save_path, "source": url}
         return (metadata, True)
 
@@ -46,15 +103,112 @@ class Downloader:
         with zipfile.ZipFile(path, 'r') as zip_ref:
             zip_ref.extractall(save_dir)
 
+    def iter_zip_members(self, metadata):
+        # Only the central directory is read here, members are decoded lazily by the runner
+        with zipfile.ZipFile(metadata["file"], "r") as zip_ref:
+            members = [
+                info for info in zip_ref.infolist()
+                if not info.is_dir()
+                and osp.splitext(info.filename)[-1].lower() in SUPPORTED_EXTENSIONS
+            ]
+        for info in members:
+            yield {
+                "archive": metadata["file"],
+                "member": info.filename,
+                "file_size": info.file_size,
+                "source": metadata["source"],
+            }
+
+    def expand_archives(self, metadata):
+        if self.stream_archives and zipfile.is_zipfile(metadata.get("file", "")):
+            yield from self.iter_zip_members(metadata)
+        else:
+            yield metadata
+
+    @staticmethod
+    def source_url(source):
+        return source if isinstance(source, str) else source["url"]
+
+    @staticmethod
+    def source_checksum(source):
+        # Manifest entries may be given as {url, size, sha256 | sha1 | md5}
+        if isinstance(source, str):
+            return {}
+        checks = {"size": source.get("size", None)}
+        for algorithm in ("sha256", "sha1", "md5"):
+            if exists(source.get(algorithm, None)):
+                checks.update(checksum=source[algorithm], algorithm=algorithm)
+                break
+        return checks
+
+    def fetch_source(self, source, save_dir=None):
+        save_dir = save_dir or self.save_dir or self.configs.get("save_dir", [])
+        path = self.source_url(source)
+        if exists(self.cache):
+            key = self.cache.key(type(self).__name__, source=path, save_dir=save_dir)
+            hit, metadata = self.cache.get(key)
+            if hit:
+                return metadata
+
+        if "youtube.com" in path:
+            metadata, _ = self.download_from_youtube(path)
+        else:
+            metadata, _ = self.download_from_url(path, save_dir, **self.source_checksum(source))
+
+        if exists(self.cache):
+            self.cache.put(key, metadata)
+        return metadata
+
+    def try_fetch_source(self, source, save_dir=None):
+        try:
+            return self.fetch_source(source, save_dir)
+        except Exception:
+            # A failed download skips its source instead of ending the whole walk
+            logger.exception(f"Failed to download {self.source_url(source)}")
+            return None
+
+    @property
+    def sources(self):
+        if not exists(self.shard):
+            return list(self.configs.sources)
+        # Hashing the source keeps the assignment stable when sources are added or reordered
+        index, count = self.shard
+        return [
+            source for source in self.configs.sources
+            if int(make_hash(self.source_url(source)), 16) % count == index
+        ]
+
     def walk_files(self, save_dir=None):
-        for path in tqdm(self.configs.sources):
-            save_dir = self.save_dir or self.configs.get("save_dir", [])
-            if "youtube.com" in path:
-                metadata, _ = self.download_from_youtube(path)
-                yield metadata
-            else:
-                metadata, _ = self.download_from_url(path, save_dir)
-                yield metadata
+        if self.prefetch_size <= 0:
+            for path in tqdm(self.sources):
+                metadata = self.try_fetch_source(path, save_dir)
+                if exists(metadata):
+                    yield from self.expand_archives(metadata)
+        else:
+            yield from self.prefetch_files(save_dir)
+
+    def prefetch_files(self, save_dir=None):
+        # Downloads run ahead of the consumer on a pool of `num_workers` threads,
+        # with at most `prefetch_size` finished or in-flight sources buffered.
+        # Files are yielded in source order so runs stay reproducible.
+        sources = iter(tqdm(self.sources))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="downloader") as pool:
+            for path in sources:
+                pending.append(pool.submit(self.try_fetch_source, path, save_dir))
+                if len(pending) >= self.prefetch_size:
+                    break
+            try:
+                while pending:
+                    metadata = pending.popleft().result()
+                    for path in sources:
+                        pending.append(pool.submit(self.try_fetch_source, path, save_dir))
+                        break
+                    if exists(metadata):
+                        yield from self.expand_archives(metadata)
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def download_file(self, metadata, save_dir):
         if "source" in metadata:
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+
+import torch
+
+from utils.helpers import exists
+from utils.loggers import get_logger
+
+logger = get_logger("module_log")
+
+GB = 1024**3
+
+
+def module_memory(obj, seen=None):
+    """Returns the bytes held by the torch modules reachable from a processor, per device type."""
+    seen = set() if seen is None else seen
+    usage = {"cpu": 0, "cuda": 0}
+    if id(obj) in seen:
+        return usage
+    seen.add(id(obj))
+
+    if isinstance(obj, torch.nn.Module):
+        for tensor in list(obj.parameters()) + list(obj.buffers()):
+            device = "cuda" if tensor.is_cuda else "cpu"
+            usage[device] += tensor.numel() * tensor.element_size()
+        return usage
+
+    if isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        children = obj
+    elif hasattr(obj, "__dict__"):
+        children = vars(obj).values()
+    else:
+        children = []
+
+    for child in children:
+        if isinstance(child, (torch.nn.Module, dict, list, tuple)) or hasattr(child, "model"):
+            child_usage = module_memory(child, seen)
+            for device in usage:
+                usage[device] += child_usage[device]
+    return usage
+
+
+class ModelCache:
+    def __init__(self, max_ram_gb=None, max_vram_gb=None) -> None:
+        self.budget = {
+            "cpu": max_ram_gb * GB if exists(max_ram_gb) else None,
+            "cuda": max_vram_gb * GB if exists(max_vram_gb) else None,
+        }
+        self.entries = OrderedDict()
+        self.stats = {"loads": 0, "hits": 0, "evictions": 0}
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def usage(self, device):
+        return sum(entry[device] for entry in self.entries.values())
+
+    def touch(self, name):
+        self.entries.move_to_end(name)
+        self.stats["hits"] += 1
+
+    def add(self, name, obj, keep=None):
+        """
+        Registers a freshly loaded processor and returns the names to evict to stay in budget.
+        Processors in `keep` (e.g. the other branches of a concurrent wave) are never evicted.
+        """
+        self.entries[name] = module_memory(obj)
+        self.entries.move_to_end(name)
+        self.stats["loads"] += 1
+        logger.info(
+            "Loaded %s (ram: %.2fGB, vram: %.2fGB)",
+            name,
+            self.entries[name]["cpu"] / GB,
+            self.entries[name]["cuda"] / GB,
+        )
+        return self.victims(keep={name, *(keep or [])})
+
+    def victims(self, keep=()):
+        victims = []
+        for device, budget in self.budget.items():
+            if not exists(budget):
+                continue
+            usage = self.usage(device) - sum(self.entries[name][device] for name in victims)
+            for name in self.entries:
+                if usage <= budget:
+                    break
+                if name in keep or name in victims or not self.entries[name][device]:
+                    continue
+                victims.append(name)
+                usage -= self.entries[name][device]
+        return victims
+
+    def remove(self, name):
+        if name in self.entries:
+            del self.entries[name]
+            self.stats["evictions"] += 1
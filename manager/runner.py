@@ -1,19 +1,22 @@
-from functools import lru_cache
 from os import path as osp
-from uuid import uuid4
-from tqdm import tqdm
-from pathlib import Path
 import inspect
-import shutil
-import json
-import time
 
-from modules.audio import convert2wav
-from config import settings
+from modules.audio import (
+    AudioWriter,
+    convert2wav,
+    decode_audio,
+    load_archive_member,
+    set_audio_writer,
+    submit_decode,
+)
+from .model_cache import ModelCache
+from .stage_cache import StageCache
+from .shard_writer import ShardWriter
+from .dag import DagExecutor
 from utils.io import load_configs, merge_configs
 from utils.helpers import exists, get_obj_from_str
 from utils.loggers import get_logger
-import torchaudio
+import torch
 
 logger = get_logger("module_log")
 
@@ -31,9 +34,35 @@ class Runner:
         "audio_superres",
     ]
 
-    def __init__(self, configs, lazy_load=True) -> None:
+    SOURCE_KEY = "file"
+
+    def __init__(
+        self,
+        configs,
+        lazy_load=True,
+        model_cache=None,
+        in_memory=False,
+        output_dir="data",
+        stage_cache=None,
+        audio_writer=None,
+        shards=None,
+    ) -> None:
         self.config = load_configs(configs)
         self.lazy_load = lazy_load
+        self.in_memory = in_memory
+        self.output_dir = output_dir
+        self.model_cache = ModelCache(**model_cache) if exists(model_cache) else None
+        self.stage_cache = StageCache(**stage_cache) if exists(stage_cache) else None
+        # Stages whose results turned out not to be cacheable skip hashing their inputs
+        self.uncached_stages = set()
+        self.shards = shards
+        self.prefetched = {}
+        self.audio_writer = AudioWriter(**audio_writer) if exists(audio_writer) else None
+        if exists(self.audio_writer):
+            set_audio_writer(self.audio_writer)
+        self.shard_writer = (
+            ShardWriter(osp.join(output_dir, "shards"), **shards) if exists(shards) else None
+        )
 
         self.processors = {}
         if not hasattr(self.config, "processors"):
@@ -51,6 +80,7 @@ class Runner:
                 self.processors[proc.name] = {"obj": obj(**proc.args), "loaded": True}
             else:
                 self.processors[proc.name] = {"obj": obj, "loaded": False}
+        self.dag = DagExecutor(self, self.config.processors)
 
     def load_processors(self, names=None, reload=False):
         if not (self.lazy_load or reload):
@@ -59,6 +89,14 @@ class Runner:
             names = [names]
 
         for proc in self.config.processors:
+            if (
+                exists(self.model_cache)
+                and (not exists(names) or proc.name in names)
+                and self.processors[proc.name]["loaded"]
+                and not reload
+                and proc.name in self.model_cache
+            ):
+                self.model_cache.touch(proc.name)
             if (
                 (not exists(names) or proc.name in names)
                 and (not self.processors[proc.name]["loaded"] or reload)
@@ -73,10 +111,20 @@ class Runner:
                         "obj"
                     ]()
                 self.processors[proc.name]["loaded"] = True
+                if exists(self.model_cache):
+                    # Everything requested together stays loaded, concurrent branches need all of it
+                    victims = self.model_cache.add(
+                        proc.name, self.processors[proc.name]["obj"], keep=names
+                    )
+                    if victims:
+                        self.offload_processors(victims, force=True)
 
-    def offload_processors(self, names=None):
+    def offload_processors(self, names=None, force=False):
         if exists(names) and isinstance(names, str):
             names = [names]
+        # With a model cache, processors stay resident until the memory budget forces an eviction
+        if exists(self.model_cache) and not force:
+            return
 
         for proc in self.config.processors:
             if not exists(names) or proc.name in names:
@@ -85,8 +133,16 @@ class Runner:
                     "obj": get_obj_from_str(proc.target),
                     "loaded": False,
                 }
+                if exists(self.model_cache) and proc.name in self.model_cache:
+                    self.model_cache.remove(proc.name)
                 logger.info(f"Dag {proc.name} deleted!!!")
 
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def cache_stats(self):
+        return dict(self.model_cache.stats) if exists(self.model_cache) else {}
+
     def resolve_dag_processor(self, name):
         raw_name = name
         name = name.split(".")[0]
@@ -94,120 +150,159 @@ class Runner:
         self.load_processors(name)
         return self.processors[name]["obj"]
 
-    @lru_cache()
-    def refactor_dag_name_with_ordinal(self, name):
-        name_splits = name.split(".")
+    def get_processor_config(self, name):
+        name = name.split(".")[0]
+        for proc in self.config.processors:
+            if proc.name == name:
+                return proc
 
-        if name_splits[0] not in self.processed_dags:
-            self.processed_dags[name_splits[0]] = 0
-        else:
-            self.processed_dags[name_splits[0]] += 1
+    def use_stage_cache(self, name):
+        proc = self.get_processor_config(name)
+        return (
+            exists(self.stage_cache)
+            and exists(proc)
+            and proc.get("cache", True)
+            and proc.name not in self.uncached_stages
+        )
 
-        if len(name_splits) == 1:
-            name = name + f".{len(self.processed_dags[name])}"
-        else:
-            name = name
+    def cache_stage_output(self, name, key, output):
+        proc = self.get_processor_config(name)
+        if not self.stage_cache.put(key, output, cache_tensors=proc.get("cache_tensors", None)):
+            logger.info("Results of %s hold audio tensors, they are not cached", proc.name)
+            self.uncached_stages.add(proc.name)
+
+    def stage_cache_key(self, name, kwargs):
+        proc = self.get_processor_config(name)
+        return self.stage_cache.key(proc.target, proc.get("args", None), **kwargs)
+
+    def run_dag(self, name, /, **kwargs):
+        # `name` is positional only, processors such as chunking take a `name` argument of their own
+        use_cache = self.use_stage_cache(name)
+        if use_cache:
+            key = self.stage_cache_key(name, kwargs)
+            hit, output = self.stage_cache.get(key)
+            if hit:
+                return output
 
-    def run_dag(self, name, **kwargs):
         processor = self.resolve_dag_processor(name)
-        return processor(**kwargs)
+        output = processor(**kwargs)
+        if use_cache:
+            self.cache_stage_output(name, key, output)
+        return output
+
+    def run_dag_batch(self, name, inputs, batch_size=None):
+        use_cache = self.use_stage_cache(name)
+        outputs, keys, pending = [None] * len(inputs), [None] * len(inputs), []
+        for i, kwargs in enumerate(inputs):
+            if use_cache:
+                keys[i] = self.stage_cache_key(name, kwargs)
+                hit, outputs[i] = self.stage_cache.get(keys[i])
+                if hit:
+                    continue
+            pending.append(i)
+        if not pending:
+            return outputs
+
+        processor = self.resolve_dag_processor(name)
+        if hasattr(processor, "batch"):
+            results = processor.batch([inputs[i] for i in pending], batch_size=batch_size)
+        else:
+            results = [processor(**inputs[i]) for i in pending]
+        for i, output in zip(pending, results):
+            outputs[i] = output
+            if use_cache:
+                self.cache_stage_output(name, keys[i], output)
+        return outputs
+
+    def flush_writes(self):
+        if exists(self.audio_writer):
+            self.audio_writer.flush()
+
+    def write_shards(self, items):
+        if exists(self.shard_writer):
+            for item in items:
+                self.shard_writer.write(item)
+
+    def close(self):
+        if exists(self.audio_writer):
+            set_audio_writer(None)
+            self.audio_writer.close()
+        if exists(self.shard_writer):
+            self.shard_writer.close()
 
     def cleanup_dag(self, name):
         if self.lazy_load:
             logger.info("Cleaning up dag: %s", name)
             self.offload_processors(name)
 
+    def source_id(self, file_metadata):
+        return tuple(file_metadata.get(key) for key in (self.SOURCE_KEY, "archive", "member"))
 
-class YoutubeRunner(Runner):
-    def __init__(self, configs, lazy_load=True) -> None:
-        super().__init__(configs, lazy_load)
+    def read_source(self, file_metadata):
+        if "member" in file_metadata:
+            return load_archive_member(file_metadata["archive"], file_metadata["member"])
+        if self.in_memory and self.dag.streams_source():
+            # Streaming processors decode the source themselves, block by block
+            return file_metadata[self.SOURCE_KEY]
+        if self.in_memory:
+            # Decoded straight to a tensor, skipping the intermediate wav
+            return decode_audio(file_metadata[self.SOURCE_KEY])
+        return convert2wav(file_metadata[self.SOURCE_KEY])
 
-    def __call__(self, file_metadata, **kwargs):
-        cache_dir = osp.join(settings.CACHE_DIR, "tmp", str(uuid4()))
-        # print(file_metadata["video"].split("/")[-1])
-        wav_path = convert2wav(file_metadata["video"])
-        dag_name = "chunking"
-        logger.info(f"Running pipeline -> {dag_name}")
-        now = time.time()
-        audio_chunks = self.run_dag(
-            dag_name,
-            audio_path=wav_path,
-            save_to_file=True,
-            save_dir=osp.join("data", file_metadata["video"].split("/")[-1][:-4],"chunked_audio"),
-        )
-        file_metadata[dag_name] = audio_chunks
-        file_metadata[f"{dag_name}_proc_time"] = time.time() - now
-        dag_name = "denoise_audio"
-        logger.info(f"Running pipeline -> {dag_name}")
-        total_time = 0
-        for v, va in tqdm(
-            enumerate(file_metadata["chunking"]["audio_chunks"]),
-            desc=dag_name,
-        ):
-            now = time.time()
-            enhanced_audio = self.run_dag(
-                dag_name,
-                audio_path=va["filepath"],
-                save_to_file=True,
-                save_dir=osp.join("data", file_metadata["video"].split("/")[-1][:-4],"denoise_audio"),
-            )
-            proc_time = time.time() - now
-            file_metadata["chunking"]["audio_chunks"][v].update(
-                {dag_name: enhanced_audio, "enhancement_proc_time": proc_time}
-            )
-            total_time += proc_time
-        file_metadata[f"{dag_name}_proc_time"] = total_time
-        self.cleanup_dag(dag_name)
-
-        dag_name = "audio_superres"
-        logger.info(f"Running pipeline -> {dag_name}")
-        total_time = 0
-
-        for v, va in tqdm(
-            enumerate(file_metadata["chunking"]["audio_chunks"]),
-            desc=dag_name,
-        ):
-            now = time.time()
-            enhanced_audio = self.run_dag(
-                dag_name,
-                audio_path=va["denoise_audio"],
-                save_to_file=True,
-                save_dir=osp.join("data", file_metadata["video"].split("/")[-1][:-4],"superres_audio"),
-            )
-            proc_time = time.time() - now
-            file_metadata["chunking"]["audio_chunks"][v].update(
-                {dag_name: enhanced_audio, "enhancement_proc_time": proc_time}
-            )
-            total_time += proc_time
-        file_metadata[f"{dag_name}_proc_time"] = total_time
-        self.cleanup_dag(dag_name)
-
-        dag_name = "transcription"
-        logger.info(f"Running pipeline -> {dag_name}")
-        total_time = 0
-        print(file_metadata)
-        for v, va in tqdm(
-            enumerate(file_metadata["chunking"]["audio_chunks"]),
-            desc=dag_name,
+    def prefetch(self, file_metadata):
+        """Starts decoding an upcoming file on the shared decode pool while the current one is processed."""
+        if exists(self.stage_cache) and exists(self.completed(self.completion_key(file_metadata))):
+            return
+        self.prefetched[self.source_id(file_metadata)] = submit_decode(self.read_source, file_metadata)
+
+    def load_source(self, file_metadata):
+        if "member" in file_metadata:
+            name = osp.splitext(file_metadata["member"])[0].replace("/", "_")
+        else:
+            name = osp.splitext(osp.basename(file_metadata[self.SOURCE_KEY]))[0]
+        future = self.prefetched.pop(self.source_id(file_metadata), None)
+        return future.result() if exists(future) else self.read_source(file_metadata), name
+
+    def completion_key(self, file_metadata):
+        # A file is done for the same source content run through the same pipeline
+        source = {key: file_metadata[key] for key in (self.SOURCE_KEY, "archive", "member") if key in file_metadata}
+        pipeline = {"processors": self.config.processors, "in_memory": self.in_memory, "shards": self.shards}
+        return self.stage_cache.key(type(self).__name__, pipeline, **source)
+
+    def completed(self, key):
+        """Metadata recorded by an earlier run that finished the file under `key`, if any."""
+        hit, done = self.stage_cache.get(key)
+        if not hit:
+            return None
+        # Items of a shard that was never finished have to be packed again
+        if exists(self.shard_writer) and not all(
+            key in self.shard_writer.written for key in self.dag.shard_keys(done)
         ):
-            now = time.time()
-            transcription = self.run_dag(
-                dag_name,
-                audio_path=va["audio_superres"]
-            )
-            proc_time = time.time() - now
-            total_time += proc_time
-            transcript_path = osp.join("data", file_metadata["video"].split("/")[-1][:-4],"transcription")
-            
-            make_path = Path(transcript_path)
-            make_path.mkdir(parents=True, exist_ok=True)
-
-            file_path = transcript_path+"/"+va["filepath"].split("/")[-1][:-4]+".txt"
-            with open(file_path, 'w', encoding='utf-8') as transcript_file:
-                transcript_file.write(transcription)
-            file_metadata["chunking"]["audio_chunks"][v].update(
-                    {dag_name: enhanced_audio, "enhancement_proc_time": proc_time}
+            return None
+        return done
+
+    def __call__(self, file_metadata, **kwargs):
+        if exists(self.stage_cache):
+            done_key = self.completion_key(file_metadata)
+            done = self.completed(done_key)
+            if exists(done):
+                logger.info(
+                    "Skipping %s, it was completed by an earlier run",
+                    file_metadata.get("source", file_metadata.get(self.SOURCE_KEY)),
                 )
-        file_metadata[f"{dag_name}_proc_time"] = total_time
-        self.cleanup_dag(dag_name)
+                return done
+
+        source, name = self.load_source(file_metadata)
+        save_dir = osp.join(self.output_dir, name)
+        file_metadata = self.dag(file_metadata, source=source, save_dir=save_dir, name=name)
+        if exists(self.stage_cache):
+            self.stage_cache.put(done_key, file_metadata)
+        if exists(self.model_cache):
+            logger.info("Model cache stats: %s", self.cache_stats())
+        if exists(self.stage_cache):
+            logger.info("Stage cache stats: %s", self.stage_cache.stats)
         return file_metadata
+
+
+class YoutubeRunner(Runner):
+    SOURCE_KEY = "video"
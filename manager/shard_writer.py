@@ -0,0 +1,167 @@
+from os import path as osp
+from pathlib import Path
+import io
+import os
+import json
+import tarfile
+import time
+
+from modules.audio import encode_audio
+from utils.helpers import exists
+from utils.loggers import get_logger
+
+logger = get_logger("module_log")
+
+INDEX_FILE = "index.jsonl"
+
+
+class ShardWriter:
+    """Packs items into fixed-size tar shards readable sequentially (webdataset layout).
+
+    Every item becomes `<key>.<audio_format>`, `<key>.json` and, when it was
+    transcribed, `<key>.txt` members next to each other. `index.jsonl` records
+    the shard, offset and size of every member so single items can be read
+    back without scanning a shard. A shard is written as `.tar.part` and only
+    renamed, and its index entries appended, once it is complete.
+    """
+
+    def __init__(
+        self,
+        output_dir,
+        audio_key,
+        text_key=None,
+        audio_format="flac",
+        max_shard_size_mb=1024,
+        max_shard_items=None,
+        prefix="audio",
+    ) -> None:
+        self.output_dir = output_dir
+        self.audio_key = audio_key
+        self.text_key = text_key
+        self.audio_format = audio_format
+        self.max_shard_size = max_shard_size_mb * (1 << 20)
+        self.max_shard_items = max_shard_items
+        self.prefix = prefix
+
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        # Items packed by an earlier run are not packed again when it is resumed
+        self.written = self.load_index()
+        self.index = open(osp.join(output_dir, INDEX_FILE), "a", encoding="utf-8")
+        # Appending to an existing output continues after the shards already written
+        self.shard_id = len(self.shard_names())
+        self.file = None
+        self.tar = None
+        self.shard_items = 0
+        self.pending = []
+
+    def load_index(self):
+        index_path = osp.join(self.output_dir, INDEX_FILE)
+        if not osp.isfile(index_path):
+            return {}
+        shards = set(self.shard_names())
+        written = {}
+        with open(index_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of a run that was killed mid-write
+                    continue
+                if entry["shard"] in shards:
+                    written[entry["key"]] = entry["shard"]
+        return written
+
+    def shard_names(self):
+        return sorted(p.name for p in Path(self.output_dir).glob(f"{self.prefix}-*.tar"))
+
+    @property
+    def shard_name(self):
+        return f"{self.prefix}-{self.shard_id:06d}.tar"
+
+    def open_shard(self):
+        # A `.part` left by a crashed run holds no indexed items and is overwritten
+        self.file = open(osp.join(self.output_dir, f"{self.shard_name}.part"), "wb")
+        self.tar = tarfile.open(fileobj=self.file, mode="w")
+        self.shard_items = 0
+
+    def close_shard(self):
+        if not exists(self.tar):
+            return
+        self.tar.close()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        path = osp.join(self.output_dir, self.shard_name)
+        os.replace(f"{path}.part", path)
+        # Index entries only ever point into shards that are complete on disk
+        self.index.writelines(self.pending)
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.file, self.tar, self.pending = None, None, []
+        self.shard_id += 1
+
+    def shard_full(self):
+        if exists(self.max_shard_items) and self.shard_items >= self.max_shard_items:
+            return True
+        return self.tar.offset >= self.max_shard_size
+
+    def add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        # The data sits right before the tar's write position, padded to whole blocks
+        padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return [self.tar.offset - padded, info.size]
+
+    def audio_bytes(self, audio):
+        if isinstance(audio, tuple):
+            return encode_audio(audio[0], audio[1], self.audio_format), self.audio_format
+        # Already persisted, the file is packed as is
+        with open(audio, "rb") as f:
+            return f.read(), osp.splitext(audio)[-1].lstrip(".")
+
+    def write(self, item):
+        try:
+            audio = item.get(self.audio_key)
+        except KeyError:
+            audio = None
+        if not exists(audio):
+            logger.warning(f"{item.name} has no '{self.audio_key}' audio, it is left out of the shards")
+            return None
+
+        # Dots separate the key from the extension in webdataset members
+        key = item.name.replace(".", "_")
+        if key in self.written:
+            item.metadata.update(tar_shard=self.written[key], key=key)
+            return key
+
+        if not exists(self.tar):
+            self.open_shard()
+        data, ext = self.audio_bytes(audio)
+        members = {ext: self.add_member(f"{key}.{ext}", data)}
+        metadata = {**item.metadata, "tar_shard": self.shard_name, "key": key}
+        members["json"] = self.add_member(f"{key}.json", json.dumps(metadata, default=str).encode("utf-8"))
+        text = item.metadata.get(self.text_key) if exists(self.text_key) else None
+        if isinstance(text, str):
+            members["txt"] = self.add_member(f"{key}.txt", text.encode("utf-8"))
+
+        self.pending.append(json.dumps({"key": key, "shard": self.shard_name, "members": members}) + "\n")
+        self.written[key] = self.shard_name
+        self.shard_items += 1
+        item.metadata.update(tar_shard=self.shard_name, key=key)
+        if self.shard_full():
+            self.close_shard()
+        return key
+
+    def close(self):
+        self.close_shard()
+        self.index.close()
+
+
+def read_item(shard_dir, entry, member):
+    """Reads one member of an indexed item without going through the rest of its shard."""
+    offset, size = entry["members"][member]
+    with open(osp.join(shard_dir, entry["shard"]), "rb") as f:
+        f.seek(offset)
+        return f.read(size)
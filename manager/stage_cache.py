@@ -0,0 +1,98 @@
+from functools import lru_cache
+from os import path as osp
+from pathlib import Path
+from hashlib import sha1
+import os
+import threading
+
+import torch
+from omegaconf import OmegaConf, DictConfig, ListConfig
+
+from config import settings
+from modules.audio import is_pending_write
+from utils.helpers import hash_file, make_hash
+from utils.loggers import get_logger
+
+logger = get_logger("module_log")
+
+
+@lru_cache(maxsize=4096)
+def _file_hash(path, size, mtime):
+    return hash_file(path)
+
+
+def content_hash(value):
+    """Replaces files and tensors by a digest of their content so equal inputs map to equal keys."""
+    if isinstance(value, (DictConfig, ListConfig)):
+        value = OmegaConf.to_container(value, resolve=True)
+    if isinstance(value, str) and osp.isfile(value):
+        stat = os.stat(value)
+        return {"file": _file_hash(value, stat.st_size, stat.st_mtime_ns)}
+    if isinstance(value, torch.Tensor):
+        tensor = value.detach().cpu().contiguous()
+        digest = sha1(tensor.numpy().tobytes()).hexdigest()
+        return {"tensor": digest, "shape": list(tensor.shape), "dtype": str(tensor.dtype)}
+    if isinstance(value, dict):
+        return {str(k): content_hash(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [content_hash(v) for v in value]
+    return value
+
+
+def referenced_paths(value):
+    if isinstance(value, str):
+        # Outputs still queued in the audio writer will be on disk by the time the stage completes
+        return [value] if osp.isfile(value) or is_pending_write(value) else []
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [path for v in value for path in referenced_paths(v)]
+    return []
+
+
+def holds_tensor(value):
+    if isinstance(value, torch.Tensor):
+        return True
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return any(holds_tensor(v) for v in value)
+    return False
+
+
+class StageCache:
+    def __init__(self, cache_dir=None, cache_tensors=False) -> None:
+        self.cache_dir = cache_dir or osp.join(settings.CACHE_DIR, "stages")
+        # In-memory audio is cheaper to recompute than to write to and read back from disk
+        self.cache_tensors = cache_tensors
+        self.stats = {"hits": 0, "misses": 0}
+
+    def key(self, target, args=None, **inputs):
+        payload = {"target": target, "args": content_hash(args), "inputs": content_hash(inputs)}
+        return make_hash(payload, serializer="json")
+
+    def path(self, key):
+        return osp.join(self.cache_dir, key[:2], f"{key}.pt")
+
+    def get(self, key):
+        path = self.path(key)
+        if osp.isfile(path):
+            entry = torch.load(path)
+            # Results pointing at files are only reusable while those files are still around
+            if all(osp.isfile(p) for p in entry["paths"]):
+                self.stats["hits"] += 1
+                return True, entry["value"]
+        self.stats["misses"] += 1
+        return False, None
+
+    def put(self, key, value, cache_tensors=None):
+        cache_tensors = self.cache_tensors if cache_tensors is None else cache_tensors
+        if not cache_tensors and holds_tensor(value):
+            return False
+        path = self.path(key)
+        Path(osp.dirname(path)).mkdir(parents=True, exist_ok=True)
+        # Concurrent branches can produce the same entry, every writer gets its own temporary file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save({"value": value, "paths": referenced_paths(value)}, tmp_path)
+        os.replace(tmp_path, path)
+        return True
@@ -1,16 +1,42 @@
+import torch
 import torchaudio
 import lameenc
+import numpy as np
+import zipfile
+import io
+import os
+import sqlite3
+import struct
+import subprocess
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import path as osp
 from pathlib import Path
-from os import system as os_system
 from collections import namedtuple
 
+from config import settings
+
 FFMPEG_BIN = "ffmpeg"
+SAMPLE_RATE = 16000
+DECODE_WORKERS = min(8, os.cpu_count() or 1)
+SUPPORTED_EXTENSIONS = [".sph", ".wav", ".mp3", ".flac", ".ogg", ".mp4"]
+INFO_CACHE_PATH = osp.join(settings.CACHE_DIR, "audio_info.sqlite")
 Info = namedtuple("Info", ["length", "sample_rate", "channels"])
 def load_audio(audio_path):
     audio, sr = torchaudio.load(audio_path)
     return audio, sr
 
-def get_audio_info(audio_path):
+def probe_audio_info(audio_path):
+    # Only the header is read, wav files do not even need a backend
+    if Path(audio_path).suffix.lower() == ".wav":
+        try:
+            with wave.open(str(audio_path), "rb") as f:
+                return Info(f.getnframes(), f.getframerate(), f.getnchannels())
+        except (wave.Error, EOFError):
+            # e.g. float or extensible wavs, which the wave module cannot parse
+            pass
     info = torchaudio.info(audio_path)
     if hasattr(info, "num_frames"):
         return Info(info.num_frames, info.sample_rate, info.num_channels)
@@ -18,6 +44,148 @@ def get_audio_info(audio_path):
         siginfo = info[0]
         return Info(siginfo.length // siginfo.channels, siginfo.rate, siginfo.channels)
 
+class AudioInfoCache:
+    """
+    On-disk store of probed audio headers keyed by path, size and mtime, so it stays valid across runs
+    and entries of files that changed are simply never hit again.
+    """
+
+    def __init__(self, db_path=INFO_CACHE_PATH) -> None:
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            Path(osp.dirname(self.db_path)).mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS info (path TEXT, size INTEGER, mtime INTEGER, "
+                "length INTEGER, sample_rate INTEGER, channels INTEGER, PRIMARY KEY (path, size, mtime))"
+            )
+        return self.conn
+
+    def get(self, path, size, mtime):
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT length, sample_rate, channels FROM info WHERE path = ? AND size = ? AND mtime = ?",
+                (path, size, mtime),
+            ).fetchone()
+        return Info(*row) if row else None
+
+    def put(self, path, size, mtime, info):
+        with self.lock:
+            conn = self.connect()
+            conn.execute("DELETE FROM info WHERE path = ?", (path,))
+            conn.execute("INSERT INTO info VALUES (?, ?, ?, ?, ?, ?)", (path, size, mtime, *info))
+            conn.commit()
+
+info_cache = AudioInfoCache()
+
+@lru_cache(maxsize=100_000)
+def _cached_audio_info(path, size, mtime):
+    try:
+        info = info_cache.get(path, size, mtime)
+    except sqlite3.Error:
+        info = None
+    if info is None:
+        info = probe_audio_info(path)
+        try:
+            info_cache.put(path, size, mtime, info)
+        except sqlite3.Error:
+            # A read-only or locked cache only costs us the next lookup
+            pass
+    return info
+
+def get_audio_info(audio_path):
+    path = osp.abspath(audio_path)
+    stat = os.stat(path)
+    return _cached_audio_info(path, stat.st_size, stat.st_mtime_ns)
+
+WAV_FORMAT_PCM = 1
+WAV_FORMAT_FLOAT = 3
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+WAV_DTYPES = {
+    (WAV_FORMAT_PCM, 16): np.dtype("<i2"),
+    (WAV_FORMAT_PCM, 32): np.dtype("<i4"),
+    (WAV_FORMAT_FLOAT, 32): np.dtype("<f4"),
+    (WAV_FORMAT_FLOAT, 64): np.dtype("<f8"),
+}
+
+class WavMap:
+    """
+    Memory-mapped view of a wav file. Samples are paged in by the OS as they are touched, so
+    slicing a chunk out of a multi-hour recording costs neither a decode nor RAM for the whole file.
+    """
+
+    def __init__(self, path, dtype, offset, num_frames, sample_rate, channels) -> None:
+        self.path = str(path)
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.data = np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=(num_frames, channels))
+        # Integer samples are scaled to [-1, 1] the way torchaudio.load does
+        self.scale = 1.0 / (np.iinfo(dtype).max + 1) if dtype.kind == "i" else 1.0
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def samples(self):
+        """Unscaled (channels, time) view of the whole file, nothing is read until it is sliced."""
+        return self.data.T
+
+    def view(self, offset, length):
+        return self.samples[:, offset : offset + length]
+
+    def read(self, offset=0, length=None):
+        length = len(self) - offset if length is None else length
+        wav = np.asarray(self.view(offset, length), dtype=np.float32)
+        if self.scale != 1.0:
+            wav = wav * np.float32(self.scale)
+        return torch.from_numpy(np.ascontiguousarray(wav))
+
+def parse_wav_header(f):
+    riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        return None
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, size = struct.unpack("<4sI", header)
+        if chunk_id == b"fmt ":
+            body = f.read(size)
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+            if format_tag == WAV_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # The first two bytes of the sub-format GUID hold the actual format tag
+                format_tag = struct.unpack("<H", body[24:26])[0]
+            fmt = (format_tag, bits, channels, sample_rate)
+            f.seek(size % 2, os.SEEK_CUR)
+        elif chunk_id == b"data":
+            return (fmt, f.tell(), size) if fmt is not None else None
+        else:
+            f.seek(size + size % 2, os.SEEK_CUR)
+
+def open_wav(audio_path):
+    """Returns a WavMap of `audio_path`, or None when it is not a wav whose samples can be mapped as is."""
+    if Path(audio_path).suffix.lower() != ".wav":
+        return None
+    with open(audio_path, "rb") as f:
+        try:
+            header = parse_wav_header(f)
+        except struct.error:
+            return None
+    if header is None:
+        return None
+    (format_tag, bits, channels, sample_rate), offset, size = header
+    dtype = WAV_DTYPES.get((format_tag, bits))
+    if dtype is None:
+        return None
+    # Streamed wavs may leave the data size unset, the file size bounds it either way
+    size = min(size, os.path.getsize(audio_path) - offset)
+    return WavMap(audio_path, dtype, offset, size // (dtype.itemsize * channels), sample_rate, channels)
+
 def normalize_audio(wav):
     return wav / max(wav.abs().max().item(), 1)
 
@@ -26,43 +194,349 @@ def convert_channels(wav, channels):
         wav = wav.mean(dim=0, keepdim=True).expand(channels, -1)
     return wav
 
+@lru_cache(maxsize=64)
+def get_resampler(from_sr, to_sr, dtype=torch.float32, device="cpu"):
+    # Building the sinc kernel costs more than applying it to a short chunk, so it is built once per rate pair
+    return torchaudio.transforms.Resample(from_sr, to_sr, dtype=dtype).to(device)
+
+def resample(wav, from_sr, to_sr):
+    if from_sr == to_sr:
+        return wav
+    return get_resampler(from_sr, to_sr, wav.dtype, str(wav.device))(wav)
+
 def convert_audio(wav, from_sr, to_sr, channels):
-    if from_sr != to_sr:
-        wav = torchaudio.transforms.Resample(from_sr, to_sr)(wav)
-    return convert_channels(wav, channels)
+    return convert_channels(resample(wav, from_sr, to_sr), channels)
+
+def convert_audio_batch(wavs, from_sr, to_sr, channels):
+    """
+    Converts a list of (channels, time) tensors, resampling the ones sharing a rate in a single padded call.
+    `from_sr` is either one rate for all of them or a rate per tensor.
+    """
+    from_srs = from_sr if isinstance(from_sr, (list, tuple)) else [from_sr] * len(wavs)
+    converted = [None] * len(wavs)
+    groups = {}
+    for i, (wav, sr) in enumerate(zip(wavs, from_srs)):
+        groups.setdefault((sr, wav.dtype, str(wav.device)), []).append(i)
+
+    for (sr, _, _), indices in groups.items():
+        # Mixing down first means less to resample, both steps are linear so the result is the same
+        signals = [convert_channels(wavs[i], channels) for i in indices]
+        if sr == to_sr:
+            batch = signals
+        else:
+            lengths = [signal.shape[-1] for signal in signals]
+            padded = torch.stack(
+                [torch.nn.functional.pad(signal, (0, max(lengths) - length)) for signal, length in zip(signals, lengths)]
+            )
+            # Resample zero pads the edges itself, trailing zeros leave every chunk's own output untouched
+            resampled = resample(padded, sr, to_sr)
+            batch = [resampled[j, :, : -(-length * to_sr // sr)] for j, length in enumerate(lengths)]
+        for i, wav in zip(indices, batch):
+            converted[i] = wav
+    return converted
 
 def save_audio(wav, path, sr, bitrate=320, bits_per_sample=16):
+    """
+    Writes `wav` to `path`, formatted by its extension (wav, flac, mp3, ...). With an AudioWriter
+    installed the write is only queued, it is on disk once the writer is flushed.
+    """
+    if _audio_writer is not None:
+        return _audio_writer.submit(wav, path, sr, bitrate=bitrate, bits_per_sample=bits_per_sample)
+    write_audio(wav, path, sr, bitrate, bits_per_sample)
+    return str(path)
+
+def write_audio(wav, path, sr, bitrate=320, bits_per_sample=16):
     path = Path(path)
     if path.suffix.lower() == ".mp3":
         encode_mp3(wav, path, sr, bitrate)
     else:
         torchaudio.save(str(path), wav, sample_rate=sr, bits_per_sample=bits_per_sample)
 
+class AudioWriter:
+    """
+    Write-behind pool for save_audio, outputs are encoded and written on worker threads while the
+    caller goes on with the next chunk. At most `max_pending` outputs wait in memory, submitting
+    more blocks until a write finishes.
+    """
+
+    def __init__(self, num_workers=4, max_pending=64) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="audio_writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.pending = {}
+
+    def submit(self, wav, path, sr, **kwargs):
+        path = str(path)
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(write_audio, wav.detach().cpu(), path, sr, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        with self.lock:
+            self.futures.append(future)
+            self.pending[path] = future
+        return path
+
+    def is_pending(self, path):
+        with self.lock:
+            future = self.pending.get(str(path))
+        return future is not None and not future.done()
+
+    def flush(self):
+        """Waits for every queued write and raises the first error any of them hit."""
+        with self.lock:
+            futures, self.futures, self.pending = self.futures, [], {}
+        errors = [error for error in (future.exception() for future in futures) if error is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+
+_audio_writer = None
+
+def set_audio_writer(writer):
+    """Installs `writer` for every save_audio call of the process, None writes synchronously again."""
+    global _audio_writer
+    previous, _audio_writer = _audio_writer, writer
+    return previous
+
+def is_pending_write(path):
+    return _audio_writer is not None and _audio_writer.is_pending(path)
+
 def encode_mp3(wav, path, sr, bitrate):
-    wav = (wav.clamp_(-1, 1) * (2 ** 15 - 1)).short().data.cpu().numpy().T
-    mp3_data = lameenc.Encoder().set_bit_rate(bitrate).set_in_sample_rate(sr).set_channels(1).encode(wav.tobytes())
     with open(path, "wb") as f:
-        f.write(mp3_data)
+        f.write(mp3_bytes(wav, sr, bitrate))
+
+def mp3_bytes(wav, sr, bitrate=320):
+    wav = (wav.clamp(-1, 1) * (2 ** 15 - 1)).short().data.cpu().numpy().T
+    return lameenc.Encoder().set_bit_rate(bitrate).set_in_sample_rate(sr).set_channels(1).encode(wav.tobytes())
+
+def encode_audio(wav, sr, audio_format="wav", bitrate=320, bits_per_sample=16):
+    """Encodes `wav` in memory, returning the bytes save_audio would have written to a `.<audio_format>` file."""
+    if audio_format == "mp3":
+        return mp3_bytes(wav, sr, bitrate)
+    buffer = io.BytesIO()
+    torchaudio.save(buffer, wav.detach().cpu(), sample_rate=sr, format=audio_format, bits_per_sample=bits_per_sample)
+    return buffer.getvalue()
+
+class FFmpegError(RuntimeError):
+    pass
+
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+
+def run_ffmpeg(args, input=None):
+    cmd = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", *(["-nostdin"] if input is None else []), *args]
+    result = subprocess.run(cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise FFmpegError(f"ffmpeg exited with code {result.returncode}: {result.stderr.decode(errors='ignore').strip()}")
+    return result.stdout
+
+def decode_audio(src, sr=SAMPLE_RATE, channels=1, start_tm=None, end_tm=None):
+    """
+    Decodes a path, bytes or file-like object with ffmpeg into a (channels, time) float tensor at `sr` Hz.
+    """
+    data = None
+    if isinstance(src, (bytes, bytearray)):
+        data, src = bytes(src), "pipe:0"
+    elif hasattr(src, "read"):
+        data, src = src.read(), "pipe:0"
+    trim = [*(["-ss", str(start_tm)] if start_tm is not None else []), *(["-to", str(end_tm)] if end_tm is not None else [])]
+
+    raw = run_ffmpeg(
+        ["-i", str(src), *trim, "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sr), "pipe:1"],
+        input=data,
+    )
+    wav = np.frombuffer(raw, dtype=np.float32).reshape(-1, channels).T
+    return torch.from_numpy(wav.copy()), sr
+
+class StderrReader:
+    """
+    Drains a process' stderr on a thread, so ffmpeg never blocks on a full pipe while its output or
+    input is being handled. Only the last `max_bytes` are kept for the error message.
+    """
+
+    def __init__(self, stream, max_bytes=1 << 16) -> None:
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.data = b""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for block in iter(lambda: self.stream.read1(1 << 12), b""):
+            self.data = (self.data + block)[-self.max_bytes :]
+
+    def text(self):
+        self.thread.join()
+        return self.data.decode(errors="ignore").strip()
+
+def decode_stream(audio_path, sr, channels, block_size):
+    """
+    Decodes `audio_path` with ffmpeg and yields consecutive (channels, block_size) float tensors,
+    only one block is ever held in memory.
+    """
+    cmd = [
+        FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", "-i", str(audio_path),
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sr), "pipe:1",
+    ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = StderrReader(process.stderr)
+    block_bytes = block_size * channels * 4
+    try:
+        while True:
+            raw = process.stdout.read(block_bytes)
+            if not raw:
+                break
+            wav = np.frombuffer(raw[: len(raw) - len(raw) % (channels * 4)], dtype=np.float32)
+            yield torch.from_numpy(wav.reshape(-1, channels).T.copy())
+        if process.wait() != 0:
+            raise FFmpegError(f"ffmpeg failed to decode {audio_path}: {stderr.text()}")
+    finally:
+        if process.poll() is None:
+            # The consumer stopped early, nothing more is needed from ffmpeg
+            process.kill()
+            process.wait()
+        stderr.thread.join()
+        process.stdout.close()
+        process.stderr.close()
+
+def stream_audio(audio_path=None, audio=None, sr=None, block_len=10, to_sr=None, channels=None):
+    """
+    Returns the sample rate of a recording and a generator of consecutive `block_len` seconds long
+    (channels, time) float tensors covering it. Wavs are read from a memory map, other formats are
+    decoded by ffmpeg, so the whole recording is never in memory at once. Blocks keep the native
+    rate and channels unless `to_sr`/`channels` are given, resampling is then left to ffmpeg so
+    block edges leave no trace.
+    """
+    if audio is not None:
+        if to_sr is not None or channels is not None:
+            audio = convert_audio(audio, sr, to_sr or sr, channels or audio.shape[0])
+            sr = to_sr or sr
+        block_size = max(int(block_len * sr), 1)
+        return sr, (audio[:, start : start + block_size] for start in range(0, audio.shape[-1], block_size))
+
+    wav_map = open_wav(audio_path)
+    if wav_map is not None and to_sr in (None, wav_map.sample_rate):
+        block_size = max(int(block_len * wav_map.sample_rate), 1)
+        blocks = (
+            convert_channels(wav_map.read(start, block_size), channels or wav_map.channels)
+            for start in range(0, len(wav_map), block_size)
+        )
+        return wav_map.sample_rate, blocks
+
+    if to_sr is None or channels is None:
+        info = get_audio_info(audio_path)
+        to_sr, channels = to_sr or info.sample_rate, channels or info.channels
+    block_size = max(int(block_len * to_sr), 1)
+    return to_sr, decode_stream(audio_path, to_sr, channels, block_size)
+
+class WavWriter:
+    """
+    Writes a 16 bit wav block by block, so outputs of any length never need to be held in memory.
+    The file only gets its final name once it is complete.
+    """
+
+    def __init__(self, path, sr, channels) -> None:
+        self.path = str(path)
+        self.part_path = f"{self.path}.part"
+        self.sr = sr
+        self.channels = channels
+        self.file = None
+
+    def __enter__(self):
+        self.file = wave.open(self.part_path, "wb")
+        self.file.setnchannels(self.channels)
+        self.file.setsampwidth(2)
+        self.file.setframerate(self.sr)
+        return self
+
+    def write(self, wav):
+        samples = (wav.clamp(-1, 1) * (2 ** 15 - 1)).short().cpu().numpy()
+        # Transposed to (time, channels) so the bytes come out interleaved
+        self.file.writeframes(samples.T.tobytes())
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.part_path, self.path)
+        elif os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+def get_decode_pool():
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="ffmpeg")
+    return _decode_pool
+
+def submit_decode(fn, *args, **kwargs):
+    # Each decode is its own ffmpeg process, the shared pool bounds how many run at once
+    return get_decode_pool().submit(fn, *args, **kwargs)
 
 def convert_and_trim_ffmpeg(src_file, dst_file, sr, start_tm, end_tm):
-    cmd = f'{FFMPEG_BIN} -i {src_file} -ar {sr} -ac 1 -ss {start_tm} -to {end_tm} {dst_file} -y -loglevel panic'
-    os_system(cmd)
+    run_ffmpeg(["-i", str(src_file), "-ar", str(sr), "-ac", "1", "-ss", str(start_tm), "-to", str(end_tm), "-y", str(dst_file)])
+
+def pipe_to_wav(feed, dst_file, sr=SAMPLE_RATE, channels=1):
+    """
+    Decodes whatever `feed` writes into ffmpeg's stdin to a `sr` Hz wav, without an intermediate file.
+    """
+    part_file = f"{dst_file}.part"
+    cmd = [
+        FFMPEG_BIN, "-loglevel", "error", "-y", "-i", "pipe:0",
+        "-ar", str(sr), "-ac", str(channels), "-f", "wav", part_file,
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = StderrReader(process.stderr)
+    try:
+        feed(process.stdin)
+    except BrokenPipeError:
+        # ffmpeg gave up early, its stderr says why
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    returncode = process.wait()
+    message = stderr.text()
+    process.stderr.close()
+    if returncode != 0:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise FFmpegError(f"ffmpeg failed to decode into {dst_file}: {message}")
+    os.replace(part_file, dst_file)
+    return dst_file
+
+def get_duration(wave_file):
+    info = get_audio_info(wave_file)
+    return info.length / info.sample_rate
 
-def get_duration(wave_file, sr=16000):
-    y, _ = torchaudio.load(wave_file)
-    return len(y[0]) / sr
+def load_archive_member(archive_path, member, sr=SAMPLE_RATE, channels=1):
+    # Decodes straight from the compressed stream, nothing is extracted to disk
+    with zipfile.ZipFile(archive_path) as archive, archive.open(member) as f:
+        return decode_audio(f, sr=sr, channels=channels)
 
 def convert2wav(audio_path):
     ext = Path(audio_path).suffix.lower()
-    supported_ext = [".sph", ".wav", ".mp3", ".flac", ".ogg", ".mp4"]
 
-    if ext not in supported_ext:
+    if ext not in SUPPORTED_EXTENSIONS:
         raise NotImplementedError(f"Audio format {ext} is not supported")
 
     if ext != ".wav":
-        dst_path = audio_path.replace(ext, ".wav")
-        cmd = f'{FFMPEG_BIN} -i {audio_path} {dst_path}'
-        os_system(cmd)
+        dst_path = str(Path(audio_path).with_suffix(".wav"))
+        if not os.path.isfile(dst_path):
+            # Written under a temporary name so a crash never leaves a truncated wav behind
+            part_path = f"{dst_path}.part"
+            run_ffmpeg(["-y", "-i", str(audio_path), "-f", "wav", part_path])
+            os.replace(part_path, dst_path)
         return dst_path
     else:
         return audio_path
@@ -4,12 +4,15 @@ from pathlib import Path
 from audiosr import super_resolution
 from functools import partial
 import argparse
+import torch
 from .common import Base
+from . import audio as audio_ops
 from modules.audio_superres_utils import load_audiosr
 from voicefixer import VoiceFixer
 from config import settings
 
 cache_dir = osp.join(settings.CACHE_DIR, "weights", "enhancement")
+VOICEFIXER_SR = 44100
 
 
 class SuperResAudio(Base):
@@ -41,7 +44,16 @@ class SuperResAudio(Base):
             latent_t_per_second=12.8
         )
         return waveform
-    def sr_with_voicefixer(self, audio_path, **kwargs):
+    def sr_with_voicefixer(self, audio_path=None, audio=None, sr=None, **kwargs):
+        if audio_path is None and audio is not None:
+            wav = audio_ops.convert_audio(audio, sr, VOICEFIXER_SR, 1).squeeze(0)
+            restored = self.model["model"].restore_inmem(
+                wav.cpu().numpy(),
+                cuda=True,
+                mode=0,
+            )
+            return torch.as_tensor(restored, dtype=torch.float32).reshape(1, -1), VOICEFIXER_SR
+
         save_dir = kwargs.get("save_dir")
         if not osp.exists(save_dir):
             os.makedirs(save_dir)
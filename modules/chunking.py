@@ -1,75 +1,244 @@
 from functools import partial
 from os import path as osp
 import os
+import torch
 import torchaudio
 from .common import Base
-from . import audio
+from . import audio as audio_ops
+from utils.helpers import exists
+from .silence_utils import EnergyEnvelope, SilenceSplitter, frame_energy, ms_to_samples
+from . import vad_utils
 from config import settings
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
+from utils.loggers import get_logger
 from typing import Any
 
+logger = get_logger("module_log")
+
 class AudioChunking(Base):
     MODEL_CHOICES = {
+        "energy_chunking": {
+            "target": "chunk_by_silence",
+        },
+        # Kept for existing configs, pydub is no longer used
         "pydub_chunking": {
             "target": "chunk_by_silence",
-        }
+        },
+        # Same silences, found block by block for recordings too long to hold in memory
+        "streaming_chunking": {
+            "target": "stream_by_silence",
+        },
+        # Cuts at pauses in speech found by webrtc's voice activity detector
+        "webrtc_vad_chunking": {
+            "target": "chunk_by_vad",
+        },
     }
     def __init__(self, model_choice: str, **kwargs) -> None:
         super().__init__(model_choice, **kwargs)
+        # Processor args (silence_len, aggressiveness, ...) are the defaults of every call
+        self.chunk_args = kwargs
 
-    def chunk_by_silence(self, audio_path, silence_len=800, silence_thresh=-40, min_chunk_len=2.0,
-                         max_chunk_len=25, **kwargs) -> Any:
-        audio_info = audio.get_audio_info(audio_path)
-        audio_segment = AudioSegment.from_wav(audio_path)
+    def chunk_by_silence(self, audio_path=None, silence_len=800, silence_thresh=-40, min_chunk_len=2.0,
+                         max_chunk_len=25, keep_silence=100, audio=None, sr=None, name=None, resplit_passes=3,
+                         resplit_silence_len_factor=0.5, resplit_thresh_step=4, num_workers=1,
+                         parallel_min_len=600, **kwargs) -> Any:
+        wav_map = None
+        if exists(audio_path):
+            # Wavs are memory-mapped, chunks are read straight from their offset in the file
+            wav_map = audio_ops.open_wav(audio_path)
+            if exists(wav_map):
+                wav, sr, scale = wav_map.samples, wav_map.sample_rate, wav_map.scale
+            else:
+                (wav, sr), scale = audio_ops.load_audio(audio_path), 1.0
+            name = name or osp.splitext(osp.basename(audio_path))[0]
+        else:
+            wav, scale = audio, 1.0
+            name = name or "audio"
 
-        # Use pydub to split audio based on silence
-        chunks = split_on_silence(audio_segment, 
-                                  min_silence_len=silence_len,
-                                  silence_thresh=silence_thresh)
+        # Same cuts as pydub's split_on_silence, from a single vectorized pass over the audio
+        # Long inputs get their envelope computed on a thread pool, short ones are not worth splitting up
+        parallel = num_workers > 1 and wav.shape[-1] / sr >= parallel_min_len
+        envelope = EnergyEnvelope.from_samples(wav, sr, scale=scale, num_workers=num_workers if parallel else 1)
+        # Segments too long to keep are split again with stricter silences instead of being dropped
+        ranges = envelope.split_recursive(
+            silence_len,
+            silence_thresh,
+            keep_silence,
+            max_samples=max_chunk_len * sr,
+            passes=resplit_passes,
+            silence_len_factor=resplit_silence_len_factor,
+            thresh_step=resplit_thresh_step,
+        )
 
         chunk_list = []
-        total_chunk_duration = 0
-
-        for i, chunk in enumerate(chunks):
-            chunk_duration = chunk.duration_seconds
+        for i, (start, end) in enumerate(ranges):
+            chunk_duration = (end - start) / sr
             if chunk_duration < min_chunk_len or chunk_duration > max_chunk_len:
                 continue
-            meta = {
-                "duration": chunk_duration,
-                "filepath": None,
-                "sample_rate": chunk.frame_rate,
-            }
+            read = lambda: wav_map.read(start, end - start) if exists(wav_map) else wav[:, start:end]
+            chunk_list.append(self.build_chunk(name, i, start, end, sr, read, **kwargs))
+
+        return self.summarize(chunk_list, wav.shape[-1], sr, name)
+
+    def iter_chunks(self, audio_path=None, silence_len=800, silence_thresh=-40, min_chunk_len=2.0,
+                    max_chunk_len=25, keep_silence=100, audio=None, sr=None, name=None, block_len=10, **kwargs):
+        """
+        Yields the chunks `chunk_by_silence` would return with `resplit_passes=0`, each as soon as
+        the silence closing it has been read. Segments longer than `max_chunk_len` are dropped. Only the samples of the chunk in progress are buffered, so memory is bounded
+        by `max_chunk_len` rather than by the length of the recording. Returns the number of samples
+        and the sample rate of the recording.
+        """
+        name = name or (osp.splitext(osp.basename(audio_path))[0] if exists(audio_path) else "audio")
+        sr, blocks = audio_ops.stream_audio(audio_path, audio, sr, block_len=block_len)
+        splitter = SilenceSplitter(sr, silence_len, silence_thresh, keep_silence)
+        # `buffer` holds the samples from `buffer_start` on, energies are known up to `energy_ms`
+        buffer, buffer_start, num_samples, energy_ms = None, 0, 0, 0
+
+        def flush(chunks):
+            for i, start_ms, end_ms in chunks:
+                start, end = splitter.sample_range(start_ms, end_ms)
+                if not min_chunk_len <= (end - start) / sr <= max_chunk_len:
+                    continue
+                # Copied so a yielded chunk does not keep the whole buffer alive
+                read = lambda: buffer[:, start - buffer_start : end - buffer_start].clone()
+                yield self.build_chunk(name, i, start, end, sr, read, **kwargs)
+
+        for block in blocks:
+            buffer = block if buffer is None else torch.cat([buffer, block], dim=-1)
+            num_samples += block.shape[-1]
+            complete_ms = num_samples * 1000 // sr
+            energy = frame_energy(
+                buffer[:, int(ms_to_samples(energy_ms, sr)) - buffer_start :],
+                sr,
+                start_ms=energy_ms,
+                num_ms=complete_ms - energy_ms,
+            )
+            energy_ms = complete_ms
+            yield from flush(splitter.feed(energy))
+
+            # Samples are kept from the start of the chunk in progress, unless it already is too
+            # long to be kept, then only those still needed for the energy of the next block
+            keep_from = ms_to_samples(energy_ms, sr)
+            too_long = splitter.base_ms - splitter.segment_start > max_chunk_len * 1000 + 1
+            if splitter.silence is not None or not too_long:
+                keep_from = min(keep_from, ms_to_samples(max(splitter.chunk_start, 0), sr))
+            if keep_from > buffer_start:
+                buffer = buffer[:, int(keep_from) - buffer_start :].clone()
+                buffer_start = int(keep_from)
+
+        if buffer is None:
+            return 0, sr
+        energy = frame_energy(buffer[:, int(ms_to_samples(energy_ms, sr)) - buffer_start :], sr, start_ms=energy_ms)
+        yield from flush(splitter.finish(energy, num_samples))
+        return num_samples, sr
 
-            total_chunk_duration += meta["duration"]
+    def stream_by_silence(self, audio_path=None, audio=None, name=None, **kwargs) -> Any:
+        name = name or (osp.splitext(osp.basename(audio_path))[0] if exists(audio_path) else "audio")
+        chunks = self.iter_chunks(audio_path, audio=audio, name=name, **kwargs)
+        chunk_list = []
+        while True:
+            try:
+                chunk_list.append(next(chunks))
+            except StopIteration as stop:
+                num_samples, sr = stop.value
+                break
+
+        return self.summarize(chunk_list, num_samples, sr, name)
+
+    def chunk_by_vad(self, audio_path=None, aggressiveness=2, frame_ms=30, smooth_ms=300, min_pause_ms=300,
+                     max_merge_gap_ms=1000, min_chunk_len=2.0, max_chunk_len=25, keep_silence=100, audio=None,
+                     sr=None, name=None, **kwargs) -> Any:
+        wav_map = audio_ops.open_wav(audio_path) if exists(audio_path) else None
+        if exists(audio_path) and not exists(wav_map):
+            audio, sr = audio_ops.load_audio(audio_path)
+        if exists(wav_map):
+            sr, num_samples = wav_map.sample_rate, len(wav_map)
+        else:
+            num_samples = audio.shape[-1]
+        name = name or (osp.splitext(osp.basename(audio_path))[0] if exists(audio_path) else "audio")
+
+        # Only the 16 bit mono copy webrtcvad needs is materialized, wavs are converted block by block
+        vad_sr = vad_utils.vad_rate(sr)
+        _, blocks = audio_ops.stream_audio(audio_path if exists(wav_map) else None, audio, sr, block_len=60)
+        pcm = vad_utils.to_pcm16(blocks, sr, vad_sr)
+        speech = vad_utils.detect_speech(pcm, vad_sr, frame_ms, aggressiveness)
+
+        scores = vad_utils.smooth(speech, smooth_ms // frame_ms)
+        mask = vad_utils.fill_gaps(scores >= 0.5, min_pause_ms // frame_ms)
+        # Room is left for the padding so padded chunks still fit in max_chunk_len
+        max_len = max(int((max_chunk_len * 1000 - 2 * keep_silence) // frame_ms), 1)
+        min_len = max(int((min_chunk_len * 1000 - 2 * keep_silence) // frame_ms), 1)
+        chunks = vad_utils.merge_segments(
+            vad_utils.runs(mask), scores, min_len, max_len, max(max_merge_gap_ms // frame_ms, 1)
+        )
+        total_ms = num_samples * 1000 // sr
+        chunks = vad_utils.pad_chunks([[start * frame_ms, end * frame_ms] for start, end in chunks], keep_silence, total_ms)
 
-            if "save_to_file" in kwargs and kwargs["save_to_file"]:
-                meta["filepath"] = self.save_to_file(chunk, chunk.frame_rate, audio_path, i, save_dir=kwargs["save_dir"])
+        chunk_list = []
+        for i, (start_ms, end_ms) in enumerate(chunks):
+            start, end = int(ms_to_samples(start_ms, sr)), int(ms_to_samples(end_ms, sr))
+            if not min_chunk_len <= (end - start) / sr <= max_chunk_len:
+                continue
+            read = lambda: wav_map.read(start, end - start) if exists(wav_map) else audio[:, start:end]
+            chunk_list.append(self.build_chunk(name, i, start, end, sr, read, **kwargs))
 
-            chunk_list.append(meta)
+        return self.summarize(chunk_list, num_samples, sr, name)
 
+    @staticmethod
+    def summarize(chunk_list, num_samples, sr, name):
+        total_chunk_duration = sum(chunk["duration"] for chunk in chunk_list)
+        # Share of the input kept as chunks
+        chunk_yield = total_chunk_duration / (num_samples / sr) if num_samples else 0.0
+        logger.info(f"Chunked {name}: kept {total_chunk_duration:.1f}s, yield {chunk_yield:.1%}")
         return {
             "audio_chunks": chunk_list,
             "total_chunk_duration": total_chunk_duration,
-            "total_audio_duration": audio_info.length,
+            "total_audio_duration": num_samples,
+            "yield": chunk_yield,
         }
 
-    def save_to_file(self, audio_chunk, sr, audio_path, chunk_idx, save_dir):       
+    def build_chunk(self, name, idx, start, end, sr, read, save_to_file=False, return_audio=False, **kwargs):
+        meta = {
+            "name": self.chunk_name(name, idx),
+            "start": start / sr,
+            "duration": (end - start) / sr,
+            "offset": start,
+            "length": end - start,
+            "filepath": None,
+            "sample_rate": sr,
+        }
+        # Samples are only read for chunks that are saved or handed on
+        if save_to_file or return_audio:
+            chunk = read()
+        if save_to_file:
+            meta["filepath"] = self.save_to_file(
+                chunk, sr, name, idx, save_dir=kwargs["save_dir"], audio_format=kwargs.get("audio_format", "wav")
+            )
+        if return_audio:
+            meta["audio"] = chunk
+        return meta
+
+    @staticmethod
+    def chunk_name(name, chunk_idx):
+        return f"{name}_chunk_{chunk_idx}"
+
+    def save_to_file(self, audio_chunk, sr, name, chunk_idx, save_dir, audio_format="wav"):
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
         
-        original_file_name = osp.basename(audio_path)
-        file_name_without_extension = osp.splitext(original_file_name)[0]
-        chunk_file_name = f"{file_name_without_extension}_chunk_{chunk_idx}.wav"
+        chunk_file_name = f"{self.chunk_name(name, chunk_idx)}.{audio_format}"
         chunk_file_path = osp.join(save_dir, chunk_file_name)
 
-        audio_chunk.export(chunk_file_path, format="wav")
+        audio_ops.save_audio(audio_chunk, chunk_file_path, sr)
         
         return chunk_file_path
 
-    def __call__(self, audio_path: str = None, **kwargs) -> Any:
-        assert audio_path is not None, "audio_path is required"
+    def __call__(self, audio_path: str = None, audio: torch.Tensor = None, **kwargs) -> Any:
+        assert exists(audio_path) or exists(
+            audio
+        ), "Either audio_path or audio tensor is required"
 
-        audio_chunks_info = self.chunk_by_silence(audio_path, **kwargs)
+        audio_chunks_info = self.target(
+            audio_path, audio=audio, **{**self.chunk_args, **kwargs}
+        )
 
         return audio_chunks_info
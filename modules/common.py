@@ -52,13 +52,13 @@ class Base:
         self.__post__init__()
 
     def __post__init__(self):
-        for key, value in self.MODEL_CHOICES.items():
-            if (
-                isinstance(value, dict)
-                and "target" in value
-                and isinstance(value["target"], str)
-            ):
-                self.MODEL_CHOICES[key]["target"] = getattr(self, value["target"])
+        # Resolved per instance, MODEL_CHOICES is shared by every instance of the class
+        self.target = self.resolve_target(self.model_choice)
+
+    def resolve_target(self, model_choice):
+        choice = self.MODEL_CHOICES[model_choice]
+        target = choice.get("target") if isinstance(choice, dict) else None
+        return getattr(self, target) if isinstance(target, str) else target
 
     @abstractmethod
     def predict(self, **kwargs):
@@ -71,13 +71,16 @@ class Base:
             audio
         ), "Either audio_path or audio tensor is required"
         if isinstance(self.model, dict):
-            prediction = self.MODEL_CHOICES[self.model_choice]["target"](
+            prediction = self.target(
                 audio_path=audio_path, audio=audio, **kwargs
             )
         else:
             prediction = self.predict(audio_path=audio_path, audio=audio, **kwargs)
         return prediction
 
+    def batch(self, inputs, batch_size=None):
+        return [self(**kwargs) for kwargs in inputs]
+
     def save_to_file(self, audio, sr, save_dir, start_dur=None, stop_dur=None):
         # Handling audio with more than 2 dimensions
         if audio.ndim > 2:
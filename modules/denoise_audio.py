@@ -5,10 +5,11 @@ from os import path as osp
 import os
 from functools import partial
 from denoiser.audio import Audioset
+from denoiser.demucs import DemucsStreamer
 
 from .common import Base
 from . import audio as audio_ops
-from .denoiser_utils import get_model
+from .denoiser_utils import get_model, prepare_model
 from utils.helpers import exists
 from config import settings
 
@@ -82,27 +83,32 @@ class DenoiseAudio(Base):
         },
     }
 
-    def _init_(
+    def __init__(
         self,
         model_choice: str,
-        sampling_rate: int = 16000,
-        padding: Union[bool,str] = True,
-        max_length: Union[int,None] = None,
-        pad_to_multiple_of: Union[int,None] = None,
-        max_audio_len: int = 5,
+        device: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        quantize: bool = False,
         dry=0,
+        streaming: bool = False,
+        frame_len: float = 10.0,
+        overlap: float = 1.0,
+        causal_streaming: bool = False,
         **kwargs,
     ) -> None:
-        super()._init_(
-            model_choice,
-            sampling_rate,
-            padding,
-            max_length,
-            pad_to_multiple_of,
-            max_audio_len,
-            **kwargs,
-        )
+        super().__init__(model_choice, **kwargs)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if exists(num_threads) and torch.device(self.device).type == "cpu":
+            torch.set_num_threads(num_threads)
+        self.model["model"] = prepare_model(self.model["model"], self.device, quantize)
         self.dry = dry
+        # Streaming denoises `frame_len` seconds at a time, so memory no longer grows with the input
+        self.streaming = streaming
+        self.frame_len = frame_len
+        self.overlap = overlap
+        # DemucsStreamer works in small frames, far slower than windows unless output is needed live
+        self.causal_streaming = causal_streaming
+
     def save_to_file(self, audio, sr, save_dir, audio_path, start_dur=None, stop_dur=None):
         # Handling audio with more than 2 dimensions
         if audio.ndim > 2:
@@ -130,26 +136,162 @@ class DenoiseAudio(Base):
         )
         audio_ops.save_audio(wav=audio, path=save_path, sr=sr)
         return save_path
-    def enhance_with_denoiser(self, audio_path, save_to_file=False, **kwargs):
+    def load_signal(self, audio_path=None, audio=None, sr=None):
+        model = self.model["model"]
+        if exists(audio):
+            return audio_ops.convert_audio(audio, sr, model.sample_rate, model.chin)
         metadata = [(audio_path, audio_ops.get_audio_info(audio_path))]
         dataset = Audioset(
             metadata,
             with_path=False,
-            sample_rate=self.model["model"].sample_rate,
-            channels=self.model["model"].chin,
+            sample_rate=model.sample_rate,
+            channels=model.chin,
             convert=True,
         )
-        signal = dataset[0]
+        return dataset[0]
+
+    def load_signals(self, inputs):
+        model = self.model["model"]
+        signals = [None] * len(inputs)
+        in_memory = [i for i, item in enumerate(inputs) if exists(item.get("audio"))]
+        converted = audio_ops.convert_audio_batch(
+            [inputs[i]["audio"] for i in in_memory],
+            [inputs[i]["sr"] for i in in_memory],
+            model.sample_rate,
+            model.chin,
+        )
+        for i, signal in zip(in_memory, converted):
+            signals[i] = signal
+        for i, item in enumerate(inputs):
+            if signals[i] is None:
+                signals[i] = self.load_signal(item.get("audio_path"))
+        return signals
+
+    def format_output(self, enhanced_audio, audio_path=None, save_to_file=False, save_dir=None):
+        sr = self.model["model"].sample_rate
+        if save_to_file:
+            return self.save_to_file(
+                enhanced_audio, sr=sr, save_dir=save_dir, audio_path=audio_path
+            )
+        return enhanced_audio, sr
+
+    def enhance_with_denoiser(self, audio_path=None, audio=None, sr=None, save_to_file=False, **kwargs):
+        if self.streaming:
+            return self.enhance_streaming(audio_path, audio, sr, save_to_file, **kwargs)
+        model = self.model["model"]
+        signal = self.load_signal(audio_path, audio, sr)
         with torch.no_grad():
-            estimate = self.model["model"](signal.cuda())
+            estimate = model(signal.to(self.device))
             # estimate = (1 - self.dry) * estimate + self.dry * signal
-        if save_to_file:
-            save_dir = kwargs.get("save_dir")
-            enhanced_audio = estimate.detach().cpu().squeeze(0)
-            denoised_path = self.save_to_file(
-                enhanced_audio, sr=16000, save_dir=save_dir, audio_path=audio_path
+        enhanced_audio = estimate.detach().cpu().squeeze(0)
+        return self.format_output(
+            enhanced_audio, audio_path, save_to_file, kwargs.get("save_dir")
+        )
+
+    def enhance_streaming(self, audio_path=None, audio=None, sr=None, save_to_file=False, save_dir=None, **kwargs):
+        model = self.model["model"]
+        _, blocks = audio_ops.stream_audio(
+            audio_path, audio, sr, block_len=self.frame_len, to_sr=model.sample_rate, channels=model.chin
+        )
+        estimates = self.stream_causal(blocks) if model.causal and self.causal_streaming else self.overlap_add(blocks)
+        if not save_to_file:
+            return torch.cat(list(estimates), dim=-1), model.sample_rate
+
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        # Written as it is denoised, the output is a wav whatever the input format was
+        save_path = osp.join(save_dir, f"{osp.splitext(osp.basename(audio_path))[0]}.wav")
+        with audio_ops.WavWriter(save_path, model.sample_rate, model.chin) as writer:
+            for estimate in estimates:
+                writer.write(estimate)
+        return save_path
+
+    def stream_causal(self, blocks):
+        # Causal models can run through the denoiser's own streamer, exactly as they would live
+        streamer = DemucsStreamer(self.model["model"], dry=self.dry)
+        with torch.no_grad():
+            for block in blocks:
+                estimate = streamer.feed(block.to(self.device))
+                if estimate.shape[-1]:
+                    yield estimate.cpu()
+            yield streamer.flush().cpu()
+
+    def overlap_add(self, blocks):
+        """
+        Denoises windows of `frame_len + overlap` seconds and cross-fades consecutive windows over
+        their `overlap` seconds, so no window edge is heard in the output.
+        """
+        model = self.model["model"]
+        hop = int(self.frame_len * model.sample_rate)
+        overlap = int(self.overlap * model.sample_rate)
+        fade_in = torch.linspace(0, 1, overlap + 2)[1:-1]
+
+        def denoise(window):
+            with torch.no_grad():
+                return model(window[None].to(self.device))[0].cpu()
+
+        def blend(estimate, tail):
+            if exists(tail):
+                length = min(tail.shape[-1], estimate.shape[-1])
+                fade = fade_in[:length]
+                estimate[:, :length] = tail[:, :length] * (1 - fade) + estimate[:, :length] * fade
+            return estimate
+
+        # `buffer` starts `overlap` samples before the next output sample once a window was denoised,
+        # `tail` is that window's estimate of those samples
+        buffer, tail = None, None
+        for block in blocks:
+            buffer = block if buffer is None else torch.cat([buffer, block], dim=-1)
+            while buffer.shape[-1] >= hop + overlap:
+                estimate = blend(denoise(buffer[:, : hop + overlap]), tail)
+                yield estimate[:, :hop]
+                tail, buffer = estimate[:, hop:], buffer[:, hop:]
+
+        if buffer is None:
+            return
+        if exists(tail) and buffer.shape[-1] <= overlap:
+            yield tail[:, : buffer.shape[-1]]
+        else:
+            yield blend(denoise(buffer), tail)
+
+    def batch(self, inputs, batch_size=8):
+        model = self.model["model"]
+        signals = self.load_signals(inputs)
+        lengths = [signal.shape[-1] for signal in signals]
+        # Sorting by length keeps the padding inside each batch small
+        order = sorted(range(len(signals)), key=lambda i: lengths[i])
+        estimates = [None] * len(signals)
+
+        normalize = model.normalize
+        model.normalize = False
+        try:
+            for start in range(0, len(order), batch_size):
+                indices = order[start : start + batch_size]
+                max_length = max(lengths[i] for i in indices)
+                batch, stds = [], []
+                for i in indices:
+                    # Normalize on the true signal, as Demucs would, so zero padding can't change the scale
+                    std = signals[i].mean(dim=0).std() if normalize else 1.0
+                    signal = signals[i] / (model.floor + std) if normalize else signals[i]
+                    batch.append(torch.nn.functional.pad(signal, (0, max_length - lengths[i])))
+                    stds.append(std)
+                with torch.no_grad():
+                    estimate = model(torch.stack(batch).to(self.device)).detach().cpu()
+                for j, i in enumerate(indices):
+                    # Demucs scales its output back by the std alone, not by `floor + std`
+                    estimates[i] = estimate[j, :, : lengths[i]] * stds[j]
+        finally:
+            model.normalize = normalize
+
+        return [
+            self.format_output(
+                enhanced_audio,
+                item.get("audio_path"),
+                item.get("save_to_file", False),
+                item.get("save_dir"),
             )
-        return denoised_path
+            for enhanced_audio, item in zip(estimates, inputs)
+        ]
 
     def predict(self, audio_path, **kwargs) -> torch.Tensor:
         if hasattr(self.model, "enhance_file"):
@@ -177,7 +319,7 @@ class DenoiseAudio(Base):
 
 
         if isinstance(self.model, dict):
-            enhanced_audio = self.MODEL_CHOICES[self.model_choice]["target"](
+            enhanced_audio = self.target(
                 audio_path=audio_path, audio=audio, **kwargs
             )
         else:
@@ -1,5 +1,6 @@
 import logging
 
+import torch
 import torch.hub
 from denoiser.demucs import Demucs
 from denoiser.utils import deserialize_model
@@ -109,4 +110,20 @@ def get_model(args):
         logger.info("Loading pre-trained real time H=48 model trained on DNS.")
         model = dns48(args.hub_dir)
     logger.debug(model)
-    return model.cuda()
+    return model
+
+
+def prepare_model(model, device="cpu", quantize=False):
+    """
+    Move a loaded model to `device`, optionally applying int8 dynamic quantization.
+    """
+    model = model.to(device).eval()
+    if quantize:
+        if torch.device(device).type != "cpu":
+            raise ValueError(f"Dynamic quantization is only supported on cpu, got {device}")
+        # Only the LSTM and linear layers have dynamically quantized kernels, convolutions stay in fp32
+        logger.info("Applying int8 dynamic quantization")
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
@@ -0,0 +1,276 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+ENERGY_BLOCK_MS = 60_000
+
+
+def ms_to_samples(ms, sr):
+    return np.asarray(ms, dtype=np.int64) * sr // 1000
+
+
+def frame_energy(samples, sr, start_ms=0, num_ms=None, block_ms=ENERGY_BLOCK_MS, scale=1.0):
+    """
+    Sum of squared samples (averaged over channels) for every millisecond of `samples`.
+
+    `samples` is a (channels, time) array or tensor, `scale` maps it to [-1, 1]. `start_ms`
+    offsets the millisecond grid so slices of a longer recording line up with it. Only one
+    block is converted to floats at a time, so memory-mapped samples are never fully loaded.
+    """
+    if isinstance(samples, torch.Tensor):
+        samples = samples.detach().cpu().numpy()
+    samples = np.atleast_2d(samples)
+    offset = int(ms_to_samples(start_ms, sr))
+    if num_ms is None:
+        num_ms = int(round(1000 * (offset + samples.shape[-1]) / sr)) - start_ms
+
+    energy = np.empty(num_ms, dtype=np.float64)
+    for block_start in range(0, num_ms, block_ms):
+        block_end = min(block_start + block_ms, num_ms)
+        bounds = ms_to_samples(np.arange(start_ms + block_start, start_ms + block_end + 1), sr) - offset
+        bounds = np.clip(bounds, 0, samples.shape[-1])
+        block = samples[:, bounds[0] : bounds[-1]].astype(np.float64)
+        power = np.square(block * scale if scale != 1.0 else block).mean(axis=0)
+        cumsum = np.concatenate([[0.0], np.cumsum(power)])
+        energy[block_start:block_end] = cumsum[bounds[1:] - bounds[0]] - cumsum[bounds[:-1] - bounds[0]]
+    return energy
+
+
+def parallel_frame_energy(samples, sr, num_workers, scale=1.0, window_ms=None):
+    """
+    `frame_energy` computed over windows on a thread pool, numpy releases the GIL while reducing
+    them. Windows are whole multiples of the energy blocks and start on the millisecond grid, so
+    every millisecond is summed exactly as in the serial pass and the result is identical to it.
+    """
+    num_samples = samples.shape[-1]
+    num_ms = int(round(1000 * num_samples / sr))
+    if window_ms is None:
+        # A few windows per worker keep them busy when windows differ in cost
+        window_ms = -(-num_ms // (4 * num_workers))
+    window_ms = max(-(-window_ms // ENERGY_BLOCK_MS), 1) * ENERGY_BLOCK_MS
+    if isinstance(samples, torch.Tensor):
+        samples = samples.detach().cpu().numpy()
+
+    def window_energy(start_ms):
+        length = min(window_ms, num_ms - start_ms)
+        start = int(ms_to_samples(start_ms, sr))
+        end = min(int(ms_to_samples(start_ms + length, sr)), num_samples)
+        return frame_energy(samples[:, start:end], sr, start_ms=start_ms, num_ms=length, scale=scale)
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        return np.concatenate([np.empty(0)] + list(pool.map(window_energy, range(0, num_ms, window_ms))))
+
+
+class EnergyEnvelope:
+    """
+    Millisecond energy envelope of a recording, supporting pydub style silence splitting
+    with array ops. Computed once, it can be re-split with different parameters for free.
+    """
+
+    def __init__(self, energy, sr, num_samples) -> None:
+        self.sr = sr
+        self.num_samples = num_samples
+        self.num_ms = len(energy)
+        self.cumsum = np.concatenate([[0.0], np.cumsum(energy)])
+        self.bounds = np.clip(ms_to_samples(np.arange(self.num_ms + 1), sr), 0, num_samples)
+
+    @classmethod
+    def from_samples(cls, samples, sr, scale=1.0, num_workers=1):
+        """With `num_workers` > 1 the energy is computed on a thread pool."""
+        if num_workers > 1:
+            energy = parallel_frame_energy(samples, sr, num_workers, scale=scale)
+        else:
+            energy = frame_energy(samples, sr, scale=scale)
+        return cls(energy, sr, samples.shape[-1])
+
+    def window_power(self, window_ms, start_ms=0, end_ms=None):
+        """Mean power of every `window_ms` long window starting between `start_ms` and `end_ms - window_ms`."""
+        end_ms = self.num_ms if end_ms is None else end_ms
+        starts = np.arange(start_ms, end_ms - window_ms + 1)
+        energy = self.cumsum[starts + window_ms] - self.cumsum[starts]
+        num_samples = np.maximum(self.bounds[starts + window_ms] - self.bounds[starts], 1)
+        return starts, energy / num_samples
+
+    def detect_silence(self, silence_len, silence_thresh, start_ms=0, end_ms=None):
+        end_ms = self.num_ms if end_ms is None else end_ms
+        if end_ms - start_ms < silence_len:
+            return np.empty((0, 2), dtype=np.int64)
+
+        starts, power = self.window_power(silence_len, start_ms, end_ms)
+        silent = starts[power <= (10 ** (silence_thresh / 20)) ** 2]
+        if not len(silent):
+            return np.empty((0, 2), dtype=np.int64)
+
+        # Silent windows closer than `silence_len` apart overlap and belong to the same range
+        breaks = np.flatnonzero(np.diff(silent) > silence_len)
+        range_starts = silent[np.concatenate([[0], breaks + 1])]
+        range_ends = silent[np.concatenate([breaks, [len(silent) - 1]])] + silence_len
+        return np.stack([range_starts, range_ends], axis=1)
+
+    def detect_nonsilent(self, silence_len, silence_thresh, start_ms=0, end_ms=None):
+        end_ms = self.num_ms if end_ms is None else end_ms
+        silent_ranges = self.detect_silence(silence_len, silence_thresh, start_ms, end_ms)
+        if not len(silent_ranges):
+            return [[start_ms, end_ms]]
+        if silent_ranges[0][0] == start_ms and silent_ranges[0][1] == end_ms:
+            return []
+
+        edges = np.concatenate([[start_ms], silent_ranges.ravel(), [end_ms]]).reshape(-1, 2)
+        return [[int(start), int(end)] for start, end in edges if end > start]
+
+    def padded_ranges(self, silence_len, silence_thresh, keep_silence=100, start_ms=0, end_ms=None):
+        """Millisecond ranges of the chunks pydub's `split_on_silence` would cut between `start_ms` and `end_ms`."""
+        end_ms = self.num_ms if end_ms is None else end_ms
+        ranges = [
+            [start - keep_silence, end + keep_silence]
+            for start, end in self.detect_nonsilent(silence_len, silence_thresh, start_ms, end_ms)
+        ]
+        # Overlapping padding is shared at the midpoint between two neighbouring chunks
+        for current, following in zip(ranges, ranges[1:]):
+            if following[0] < current[1]:
+                current[1] = (current[1] + following[0]) // 2
+                following[0] = current[1]
+
+        return [[max(start, start_ms), min(end, end_ms)] for start, end in ranges]
+
+    def to_samples(self, ranges):
+        return [(int(self.bounds[start]), int(self.bounds[end])) for start, end in ranges]
+
+    def split_on_silence(self, silence_len, silence_thresh, keep_silence=100, start_ms=0, end_ms=None):
+        """Returns the (start, end) sample ranges pydub's `split_on_silence` would cut."""
+        return self.to_samples(self.padded_ranges(silence_len, silence_thresh, keep_silence, start_ms, end_ms))
+
+    def split_recursive(self, silence_len, silence_thresh, keep_silence=100, max_samples=None, passes=3,
+                        silence_len_factor=0.5, min_silence_len=100, thresh_step=4, start_ms=0, end_ms=None):
+        """
+        Like `split_on_silence`, but ranges longer than `max_samples` are split again, up to `passes`
+        times, with shorter and louder silences counting as pauses. Every pass reuses this envelope.
+        """
+        ranges = []
+        for start, end in self.padded_ranges(silence_len, silence_thresh, keep_silence, start_ms, end_ms):
+            too_long = max_samples is not None and self.bounds[end] - self.bounds[start] > max_samples
+            if not too_long or passes <= 0:
+                ranges.append((int(self.bounds[start]), int(self.bounds[end])))
+                continue
+            ranges += self.split_recursive(
+                max(int(silence_len * silence_len_factor), min_silence_len),
+                silence_thresh + thresh_step,
+                keep_silence,
+                max_samples,
+                passes - 1,
+                silence_len_factor,
+                min_silence_len,
+                thresh_step,
+                start_ms=start,
+                end_ms=end,
+            )
+        return ranges
+
+
+class SilenceSplitter:
+    """
+    Streaming counterpart of `EnergyEnvelope.split_on_silence`. Millisecond energies are fed
+    block by block and each chunk is returned as soon as the silence closing it is complete,
+    so no more than a block plus `silence_len` of energy is ever held.
+    """
+
+    def __init__(self, sr, silence_len, silence_thresh, keep_silence=100) -> None:
+        self.sr = sr
+        self.silence_len = silence_len
+        self.keep_silence = keep_silence
+        self.threshold = (10 ** (silence_thresh / 20)) ** 2
+        # `energy` starts at `base_ms`, which is also the next window start to evaluate
+        self.base_ms = 0
+        self.energy = np.empty(0, dtype=np.float64)
+        # First and last silent window starts of the silent range still open
+        self.silence = None
+        self.segment_start = 0
+        self.chunk_start = 0
+        self.index = 0
+        self.num_ms = None
+        self.num_samples = None
+
+    @property
+    def end_ms(self):
+        return self.base_ms + len(self.energy)
+
+    def feed(self, energy):
+        """Returns the (index, start_ms, end_ms) chunks closed by the next milliseconds of energy."""
+        self.energy = np.concatenate([self.energy, energy])
+        return self.scan(self.end_ms - self.silence_len)
+
+    def finish(self, energy, num_samples):
+        """Feeds the last milliseconds of energy and returns the remaining chunks."""
+        self.energy = np.concatenate([self.energy, energy])
+        self.num_ms, self.num_samples = self.end_ms, num_samples
+        chunks = self.scan(self.num_ms - self.silence_len)
+        if self.silence is not None:
+            chunks += self.close_silence()
+        if self.num_ms > self.segment_start:
+            chunks.append(self.emit(self.num_ms))
+        return chunks
+
+    def bounds(self, ms):
+        samples = ms_to_samples(ms, self.sr)
+        return samples if self.num_samples is None else np.minimum(samples, self.num_samples)
+
+    def scan(self, last_start):
+        chunks = []
+        if last_start >= self.base_ms:
+            starts = np.arange(self.base_ms, last_start + 1)
+            cumsum = np.concatenate([[0.0], np.cumsum(self.energy)])
+            offsets = starts - self.base_ms
+            energy = cumsum[offsets + self.silence_len] - cumsum[offsets]
+            num_samples = np.maximum(self.bounds(starts + self.silence_len) - self.bounds(starts), 1)
+            silent = starts[energy / num_samples <= self.threshold]
+
+            if len(silent):
+                # Same grouping as EnergyEnvelope.detect_silence, continued from the open range
+                breaks = np.flatnonzero(np.diff(silent) > self.silence_len)
+                firsts = silent[np.concatenate([[0], breaks + 1])]
+                lasts = silent[np.concatenate([breaks, [len(silent) - 1]])]
+                groups = [[int(first), int(last)] for first, last in zip(firsts, lasts)]
+                if self.silence is not None and groups[0][0] - self.silence[1] <= self.silence_len:
+                    self.silence[1] = groups.pop(0)[1]
+                for group in groups:
+                    if self.silence is not None:
+                        chunks += self.close_silence()
+                    self.silence = group
+
+            # Windows starting before the next start are settled, their energy is not needed anymore
+            self.energy = self.energy[last_start + 1 - self.base_ms :]
+            self.base_ms = last_start + 1
+
+        if self.silence is not None and last_start >= self.silence[1] + self.silence_len:
+            chunks += self.close_silence()
+        return chunks
+
+    def close_silence(self):
+        first, last = self.silence
+        self.silence = None
+        silence_start, silence_end = first, last + self.silence_len
+        chunks = []
+        # Only the final silent range can run up to the end without audio following it
+        has_next = self.num_ms is None or silence_end < self.num_ms
+        next_start = silence_end - self.keep_silence
+        if silence_start > self.segment_start:
+            chunk_end = silence_start + self.keep_silence
+            # Overlapping padding is shared at the midpoint between two neighbouring chunks
+            if has_next and next_start < chunk_end:
+                chunk_end = next_start = (chunk_end + next_start) // 2
+            chunks.append(self.emit(chunk_end))
+        self.chunk_start = next_start
+        self.segment_start = silence_end
+        return chunks
+
+    def emit(self, end):
+        chunk = (self.index, self.chunk_start, end)
+        self.index += 1
+        return chunk
+
+    def sample_range(self, start, end):
+        """Clips a chunk's millisecond range to the audio and converts it to samples."""
+        if self.num_ms is not None:
+            end = min(end, self.num_ms)
+        return int(self.bounds(max(start, 0))), int(self.bounds(end))
@@ -31,7 +31,7 @@ class TranscribeAudio(Base):
         ),
     }
     def predict(
-        self, audio_path: str = None, audio: torch.Tensor = None, **kwargs
+        self, audio_path: str = None, audio: torch.Tensor = None, sr: int = None, **kwargs
     ) -> str:
         if exists(audio_path):
             if isinstance(self.model, whisper.Whisper):
@@ -41,5 +41,65 @@ class TranscribeAudio(Base):
                     f"{self.model_choice} doesn't have any supported methods"
                 )
         else:
-            transcription = self.model.transcribe(audio)["text"]
+            if exists(sr):
+                audio = audio_ops.convert_audio(audio, sr, whisper.audio.SAMPLE_RATE, 1)
+            transcription = self.model.transcribe(audio.squeeze(0).float())["text"]
         return transcription
+
+
+    def load_batch_audio(self, audio_path: str = None, audio: torch.Tensor = None, sr: int = None):
+        if exists(audio_path):
+            return torch.from_numpy(whisper.load_audio(audio_path))
+        if exists(sr):
+            audio = audio_ops.convert_audio(audio, sr, whisper.audio.SAMPLE_RATE, 1)
+        return audio.squeeze(0).float()
+
+    def load_batch_audios(self, inputs):
+        audios = [None] * len(inputs)
+        # In-memory chunks of the same rate are resampled together
+        resample = [i for i, item in enumerate(inputs) if exists(item.get("audio")) and exists(item.get("sr"))]
+        converted = audio_ops.convert_audio_batch(
+            [inputs[i]["audio"] for i in resample],
+            [inputs[i]["sr"] for i in resample],
+            whisper.audio.SAMPLE_RATE,
+            1,
+        )
+        for i, audio in zip(resample, converted):
+            audios[i] = audio.squeeze(0).float()
+        for i, item in enumerate(inputs):
+            if audios[i] is None:
+                audios[i] = self.load_batch_audio(item.get("audio_path"), item.get("audio"))
+        return audios
+
+    def batch(self, inputs, batch_size=16, language=None):
+        if not isinstance(self.model, whisper.Whisper):
+            return super().batch(inputs, batch_size)
+
+        audios = self.load_batch_audios(inputs)
+        transcriptions = [None] * len(inputs)
+        # Chunks fitting in one 30s window are decoded together, longer ones need transcribe's sliding window
+        for i, audio in enumerate(audios):
+            if audio.shape[-1] > whisper.audio.N_SAMPLES:
+                transcriptions[i] = self.model.transcribe(audio)["text"]
+        short = [i for i, text in enumerate(transcriptions) if text is None]
+
+        options = whisper.DecodingOptions(
+            language=language,
+            fp16=self.model.device.type == "cuda",
+            without_timestamps=True,
+        )
+        for start in range(0, len(short), batch_size):
+            indices = short[start : start + batch_size]
+            mels = torch.stack(
+                [
+                    whisper.log_mel_spectrogram(
+                        whisper.pad_or_trim(audios[i]), n_mels=self.model.dims.n_mels
+                    )
+                    for i in indices
+                ]
+            ).to(self.model.device)
+            with torch.no_grad():
+                results = whisper.decode(self.model, mels, options)
+            for i, result in zip(indices, results):
+                transcriptions[i] = result.text
+        return transcriptions
@@ -0,0 +1,96 @@
+import numpy as np
+import webrtcvad
+
+from . import audio as audio_ops
+
+VAD_SAMPLE_RATES = (8000, 16000, 32000, 48000)
+VAD_FRAME_MS = (10, 20, 30)
+
+
+def vad_rate(sr):
+    return sr if sr in VAD_SAMPLE_RATES else 16000
+
+
+def to_pcm16(blocks, sr, vad_sr):
+    """Converts (channels, time) float blocks to the 16 bit mono pcm webrtcvad expects."""
+    pcm = bytearray()
+    for block in blocks:
+        block = audio_ops.convert_audio(block, sr, vad_sr, 1)
+        pcm += (block.clamp(-1, 1) * (2 ** 15 - 1)).short().numpy().tobytes()
+    return bytes(pcm)
+
+
+def detect_speech(pcm, sr, frame_ms=30, aggressiveness=2):
+    """
+    Speech decision of every `frame_ms` frame of 16 bit mono `pcm`. webrtcvad adapts to the audio
+    it has seen, so every call starts from a fresh detector and classifies the frames in order.
+    """
+    if frame_ms not in VAD_FRAME_MS:
+        raise ValueError(f"webrtcvad supports frames of {VAD_FRAME_MS} ms, got {frame_ms}")
+    vad = webrtcvad.Vad(aggressiveness)
+    frame_bytes = sr * frame_ms // 1000 * 2
+    view = memoryview(pcm)
+    starts = range(0, len(pcm) - frame_bytes + 1, frame_bytes)
+    return np.array([vad.is_speech(view[start : start + frame_bytes], sr) for start in starts], dtype=bool)
+
+
+def smooth(speech, window):
+    """Fraction of speech frames in a `window` frames long window centered on every frame."""
+    if not len(speech):
+        return np.zeros(0)
+    window = max(int(window), 1)
+    cumsum = np.concatenate([[0], np.cumsum(speech, dtype=np.int64)])
+    starts = np.clip(np.arange(len(speech)) - window // 2, 0, len(speech))
+    ends = np.clip(starts + window, 0, len(speech))
+    return (cumsum[ends] - cumsum[starts]) / np.maximum(ends - starts, 1)
+
+
+def runs(mask):
+    """(start, end) frame ranges of the consecutive True runs of `mask`."""
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], mask.astype(np.int8), [0]])))
+    return edges.reshape(-1, 2).tolist()
+
+
+def fill_gaps(mask, max_gap):
+    """Closes pauses shorter than `max_gap` frames between two speech runs."""
+    mask = mask.copy()
+    segments = runs(mask)
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        if start - end < max_gap:
+            mask[end:start] = True
+    return mask
+
+
+def merge_segments(segments, scores, min_len, max_len, max_gap=None):
+    """
+    Greedily merges speech segments into chunks of at most `max_len` frames. A chunk is closed
+    before a pause of `max_gap` frames or more, so chunks never span long silences. Segments longer
+    than `max_len` on their own are cut at their least speech-like frame past `min_len`. Chunks
+    shorter than `min_len` frames are dropped.
+    """
+    chunks, current = [], None
+    for start, end in segments:
+        close_gap = current is not None and (max_gap is None or start - current[1] < max_gap)
+        if close_gap and end - current[0] <= max_len:
+            current[1] = end
+            continue
+        if current is not None:
+            chunks.append(current)
+        current = [start, end]
+        while current[1] - current[0] > max_len:
+            low, high = current[0] + min(min_len, max_len - 1), current[0] + max_len
+            cut = low + int(np.argmin(scores[low:high])) if high > low else high
+            chunks.append([current[0], cut])
+            current = [cut, current[1]]
+    if current is not None:
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk[1] - chunk[0] >= min_len]
+
+
+def pad_chunks(chunks, pad, total):
+    """Pads chunks by `pad` on both sides, sharing overlapping padding at the midpoint like silence splitting."""
+    padded = [[start - pad, end + pad] for start, end in chunks]
+    for current, following in zip(padded, padded[1:]):
+        if following[0] < current[1]:
+            current[1] = following[0] = (current[1] + following[0]) // 2
+    return [[max(start, 0), min(end, total)] for start, end in padded]
@@ -0,0 +1,195 @@
+import hashlib
+import http.server
+import io
+import os
+import shutil
+import threading
+import wave
+
+import numpy as np
+import pytest
+
+from manager import downloader as downloader_module
+from manager.downloader import Downloader
+from modules.audio import FFmpegError, SAMPLE_RATE
+from utils.io import download_file_from_url
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.files` by path and honors `Range: bytes=<start>-` like a file host would."""
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        start = int(self.headers["Range"][len("bytes=") : -1]) if self.headers.get("Range") else 0
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+    server.files, server.requests = {}, []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_verifies_size_and_checksum(file_server, tmp_path):
+    server, base_url = file_server
+    server.files["/data.zip"] = data = os.urandom(3 << 20)
+
+    metadata, _ = Downloader(save_dir=str(tmp_path)).download_from_url(
+        f"{base_url}/data.zip", size=len(data), checksum=hashlib.sha256(data).hexdigest()
+    )
+
+    with open(metadata["file"], "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(f"{metadata['file']}.part")
+
+
+def test_download_resumes_partial_file(file_server, tmp_path):
+    server, base_url = file_server
+    server.files["/data.zip"] = data = os.urandom(3 << 20)
+    url = f"{base_url}/data.zip"
+    save_path = Downloader.url_to_path(url, str(tmp_path))
+    with open(f"{save_path}.part", "wb") as f:
+        f.write(data[: 1 << 20])
+
+    download_file_from_url(url, save_path, show_progress=False, checksum=hashlib.sha256(data).hexdigest())
+
+    with open(save_path, "rb") as f:
+        assert f.read() == data
+    assert server.requests == [("/data.zip", f"bytes={1 << 20}-")]
+
+    # A complete file is verified and not downloaded again
+    download_file_from_url(url, save_path, show_progress=False, size=len(data))
+    assert len(server.requests) == 1
+
+
+def test_download_rejects_checksum_mismatch(file_server, tmp_path):
+    server, base_url = file_server
+    server.files["/data.zip"] = os.urandom(1 << 16)
+    save_path = str(tmp_path / "data.zip")
+
+    with pytest.raises(AssertionError):
+        download_file_from_url(f"{base_url}/data.zip", save_path, show_progress=False, checksum="0" * 64)
+    assert not os.path.exists(save_path)
+    assert not os.path.exists(f"{save_path}.part")
+
+
+def test_prefetch_yields_sources_in_order(file_server, tmp_path):
+    server, base_url = file_server
+    sources = [f"{base_url}/part_{i}.zip" for i in range(6)]
+    for i in range(6):
+        server.files[f"/part_{i}.zip"] = os.urandom(1 << 16) + bytes([i])
+    config = tmp_path / "sources.yaml"
+    config.write_text("sources:\n" + "".join(f"  - {url}\n" for url in sources))
+
+    downloader = Downloader([str(config)], save_dir=str(tmp_path / "raw"), num_workers=3, prefetch_size=4)
+    files = list(downloader.walk_files())
+
+    assert [metadata["source"] for metadata in files] == sources
+    for i, metadata in enumerate(files):
+        with open(metadata["file"], "rb") as f:
+            assert f.read() == server.files[f"/part_{i}.zip"]
+
+
+def make_wav(seconds, sr=44100, channels=2):
+    t = np.arange(int(seconds * sr)) / sr
+    samples = (np.sin(2 * np.pi * 440 * t) * 0.3 * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(np.repeat(samples[:, None], channels, axis=1).tobytes())
+    return buffer.getvalue()
+
+
+class FakeStream:
+    def __init__(self, data) -> None:
+        self.data = data
+
+    def stream_to_buffer(self, buffer):
+        # pytube writes the download in chunks as they arrive
+        for start in range(0, len(self.data), 1 << 14):
+            buffer.write(self.data[start : start + (1 << 14)])
+
+
+class FakeStreams:
+    def __init__(self, data) -> None:
+        self.data = data
+        self.filters = []
+
+    def filter(self, **kwargs):
+        self.filters.append(kwargs)
+        return self
+
+    def order_by(self, attribute):
+        return self
+
+    def desc(self):
+        return self
+
+    def first(self):
+        return FakeStream(self.data)
+
+    def get_highest_resolution(self):
+        raise AssertionError("audio only downloads must not fetch the video")
+
+
+def fake_youtube(data):
+    class FakeYouTube:
+        instances = []
+
+        def __init__(self, url) -> None:
+            self.video_id = url.rsplit("=", 1)[-1]
+            self.title = "A talk: about things"
+            self.streams = FakeStreams(data)
+            FakeYouTube.instances.append(self)
+
+    return FakeYouTube
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_audio_only_youtube_download(monkeypatch, tmp_path):
+    youtube = fake_youtube(make_wav(3.0))
+    monkeypatch.setattr(downloader_module, "YouTube", youtube)
+
+    downloader = Downloader(save_dir=str(tmp_path), audio_only=True)
+    metadata, _ = downloader.download_from_youtube("https://www.youtube.com/watch?v=abc123")
+
+    assert youtube.instances[0].streams.filters == [{"only_audio": True}]
+    assert metadata["video"] == str(tmp_path / "abc123" / "A_talk_about_things.wav")
+    with wave.open(metadata["video"]) as f:
+        assert f.getframerate() == SAMPLE_RATE
+        assert f.getnchannels() == 1
+        assert abs(f.getnframes() - 3 * SAMPLE_RATE) <= SAMPLE_RATE // 100
+
+    # The decoded wav is reused instead of fetching the stream again
+    downloader.download_from_youtube("https://www.youtube.com/watch?v=abc123")
+    assert youtube.instances[1].streams.filters == []
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_audio_only_youtube_download_failure(monkeypatch, tmp_path):
+    # Far more garbage than fits in a pipe buffer, ffmpeg reports errors while it is still fed
+    monkeypatch.setattr(downloader_module, "YouTube", fake_youtube(b"not audio" * 100000))
+
+    with pytest.raises(FFmpegError):
+        Downloader(save_dir=str(tmp_path), audio_only=True).download_from_youtube(
+            "https://www.youtube.com/watch?v=abc123"
+        )
+    assert os.listdir(tmp_path / "abc123") == []
@@ -60,5 +60,14 @@ def make_hash(data, algorithm="sha1", serializer=None, sort=False):
     return algos[algorithm.lower()](data).hexdigest()
 
 
+def hash_file(path, algorithm="sha1", chunk_size=1 << 20):
+    algos = {"sha1": sha1, "sha256": sha256, "md5": md5}
+    digest = algos[algorithm.lower()]()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def generate_oid(serialize=True):
     return str(ObjectId()) if serialize else ObjectId()
@@ -1,10 +1,16 @@
+import os
 from os import path as osp
 from pathlib import Path
 from tqdm import tqdm
 from omegaconf import OmegaConf, DictConfig, ListConfig
+from functools import lru_cache
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from .validators import uri_validator
+from .helpers import exists, hash_file
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 
 def load_configs(configs):
@@ -46,17 +52,71 @@ def save_metadata(metadata, save_path):
         else:
             raise NotImplementedError(f"{osp.splitext(save_path)[-1]} is not supported...")
 
-def download_file_from_url(url, save_path, show_progress=True):
+@lru_cache()
+def get_session(pool_size=10):
+    # Shared across downloads so connections to the same host are kept alive and reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def verify_file(path, size=None, checksum=None, algorithm="sha256"):
+    if exists(size) and osp.getsize(path) != int(size):
+        return False
+    if exists(checksum) and hash_file(path, algorithm) != checksum.lower():
+        return False
+    return True
+
+def download_file_from_url(
+    url,
+    save_path,
+    show_progress=True,
+    session=None,
+    chunk_size=DOWNLOAD_CHUNK_SIZE,
+    size=None,
+    checksum=None,
+    algorithm="sha256",
+):
     if not uri_validator(url):
         raise ValueError(f"'{url}' doesn't seem to be a valid url")
 
+    # Files only get their final name once complete, so an existing one is skipped
+    if osp.isfile(save_path) and verify_file(save_path, size, checksum, algorithm):
+        return save_path
+
     parent_dir = Path(osp.dirname(save_path))
     parent_dir.mkdir(exist_ok=True, parents=True)
 
-    with open(save_path, "wb") as handle:
-        response = requests.get(url, stream=True, timeout=20)
-        if response.status_code != 200:
+    part_path = f"{save_path}.part"
+    offset = osp.getsize(part_path) if osp.isfile(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    session = session or get_session()
+    with session.get(url, stream=True, timeout=20, headers=headers) as response:
+        if response.status_code == 416 and offset:
+            # Nothing left past the bytes we already have
+            pass
+        elif response.status_code not in (200, 206):
             raise AssertionError(f"Couldn't download the file, the url returned status code: {response.status_code}")
+        else:
+            if response.status_code == 200:
+                # The server ignored the range request, start over
+                offset = 0
+            total = int(response.headers.get("content-length", 0)) + offset or None
+            with open(part_path, "ab" if offset else "wb") as handle, tqdm(
+                total=total, initial=offset, unit="B", unit_scale=True, disable=not show_progress
+            ) as progress:
+                for data in response.iter_content(chunk_size=chunk_size):
+                    handle.write(data)
+                    progress.update(len(data))
+
+            if exists(total) and osp.getsize(part_path) != total:
+                raise AssertionError(f"Download of '{url}' stopped at {osp.getsize(part_path)} of {total} bytes")
+
+    if not verify_file(part_path, size, checksum, algorithm):
+        os.remove(part_path)
+        raise AssertionError(f"'{url}' doesn't match the expected size or {algorithm} checksum")
 
-        for data in tqdm(response.iter_content(), disable=not show_progress):
-            handle.write(data)
\ No newline at end of file
+    os.replace(part_path, save_path)
+    return save_path
@@ -0,0 +1,71 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+import argparse
+import time
+import torch
+
+from modules import DenoiseAudio
+from modules import audio as audio_ops
+
+
+def snr(reference, estimate):
+    noise = (reference - estimate).pow(2).sum()
+    return (10 * torch.log10(reference.pow(2).sum() / noise.clamp(min=1e-12))).item()
+
+
+def benchmark(denoiser, audios, repeats=1):
+    outputs, elapsed = [], 0
+    for wav, sr in audios:
+        now = time.time()
+        for _ in range(repeats):
+            enhanced, _ = denoiser(audio=wav, sr=sr)
+        elapsed += (time.time() - now) / repeats
+        outputs.append(enhanced)
+    duration = sum(wav.shape[-1] / sr for wav, sr in audios)
+    return outputs, elapsed / duration
+
+
+def run(model_choice, audio_paths, device="cpu", num_threads=None, repeats=1):
+    audios = [audio_ops.load_audio(path) for path in audio_paths]
+    results = {}
+    reference = None
+    for quantize in (False, True):
+        if quantize and torch.device(device).type != "cpu":
+            continue
+        denoiser = DenoiseAudio(
+            model_choice, device=device, num_threads=num_threads, quantize=quantize
+        )
+        outputs, rtf = benchmark(denoiser, audios, repeats)
+        if reference is None:
+            reference, score = outputs, float("inf")
+        else:
+            score = sum(snr(ref, out) for ref, out in zip(reference, outputs)) / len(outputs)
+
+        label = "int8" if quantize else "fp32"
+        results[label] = {"rtf": rtf, "snr_vs_fp32": score}
+        print(f"{model_choice} [{label}] real time factor: {rtf:.3f}, snr vs fp32: {score:.2f} dB")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Denoiser benchmark",
+        description="Compare real time factor and output snr of fp32 and int8 denoisers",
+    )
+    parser.add_argument(
+        "--model",
+        default="meta_denoiser_dns48",
+        choices=list(DenoiseAudio.MODEL_CHOICES),
+        help="Denoiser model choice",
+    )
+    parser.add_argument("--audio", nargs="+", required=True, help="Audio files to denoise")
+    parser.add_argument("--device", default="cpu", help="Device to run the denoiser on")
+    parser.add_argument("--threads", type=int, default=None, help="Number of cpu threads")
+    parser.add_argument("--repeats", type=int, default=1, help="Timed runs per file")
+    args = parser.parse_args()
+
+    run(args.model, args.audio, args.device, args.threads, args.repeats)
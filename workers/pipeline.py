@@ -5,22 +5,109 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.abspath(os.path.join(dir_path, os.pardir)))
 
 import argparse
+import json
+import multiprocessing
+from glob import glob
+from pathlib import Path
 from omegaconf import OmegaConf
 
-from utils.io import load_configs
-from utils.helpers import get_obj_from_str
+from utils.io import load_configs, load_metadata, save_metadata
+from utils.helpers import exists, get_obj_from_str
+from utils.loggers import get_logger
 
+logger = get_logger("module_log")
 
-def run(configs):
+SHARD_PREFIX = "shard_"
+
+
+def shard_name(index):
+    return f"{SHARD_PREFIX}{index:03d}"
+
+
+def parse_shard(value):
+    index, count = (int(v) for v in value.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard {value} must be formatted as i/N with 0 <= i < N")
+    return index, count
+
+
+def run(configs, shard=None):
     config = load_configs(configs)["pipeline"]
-    downloader = get_obj_from_str(config["loader"]["target"])(
-        **config["loader"]["args"]
-    )
+    loader_args = dict(config["loader"].get("args", None) or {})
+    manager_args = dict(config["manager"].get("args", None) or {})
+    output_dir = manager_args.get("output_dir", "data")
+
+    if exists(shard):
+        # Each shard downloads into and writes to its own subtree
+        loader_args["shard"] = shard
+        loader_args["save_dir"] = os.path.join(loader_args.get("save_dir", "data/"), shard_name(shard[0]))
+        output_dir = os.path.join(output_dir, shard_name(shard[0]))
+        manager_args["output_dir"] = output_dir
+
+    downloader = get_obj_from_str(config["loader"]["target"])(**loader_args)
     manager = get_obj_from_str(config["manager"]["target"])(
-        configs=OmegaConf.to_yaml(config)
+        configs=OmegaConf.to_yaml(config), **manager_args
     )
-    for file_metadata in downloader.walk_files():
-        manager(file_metadata=file_metadata)
+    metadata, failed = [], []
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    try:
+        # Records are appended as files complete, so a crash keeps those of every finished file
+        with open(os.path.join(output_dir, "metadata.jsonl"), "w") as f:
+            files = downloader.walk_files()
+            upcoming = next(files, None)
+            while exists(upcoming):
+                file_metadata, upcoming = upcoming, next(files, None)
+                if exists(upcoming):
+                    # The next source is decoded while this one runs through the processors
+                    manager.prefetch(upcoming)
+                try:
+                    entry = manager(file_metadata=file_metadata)
+                except Exception:
+                    # One broken source must not cost the rest of the shard
+                    logger.exception(f"Failed to process {file_metadata.get('source', file_metadata)}")
+                    failed.append(file_metadata)
+                    continue
+                metadata.append(entry)
+                f.write(f"{json.dumps(entry)}\n")
+                f.flush()
+    finally:
+        manager.close()
+    if failed:
+        logger.warning(f"{len(failed)} files failed, see {os.path.join(output_dir, 'failed.jsonl')}")
+        save_metadata(failed, os.path.join(output_dir, "failed.jsonl"))
+    return metadata
+
+
+def merge_metadata(configs):
+    config = load_configs(configs)["pipeline"]
+    output_dir = (config["manager"].get("args", None) or {}).get("output_dir", "data")
+    metadata = []
+    for shard_dir in sorted(glob(os.path.join(output_dir, f"{SHARD_PREFIX}*"))):
+        if not os.path.isfile(os.path.join(shard_dir, "metadata.jsonl")):
+            continue
+        # Kept apart from `tar_shard`, the tar file a packed item was written to
+        worker_shard = os.path.basename(shard_dir)
+        metadata.extend({**entry, "worker_shard": worker_shard} for entry in load_metadata(shard_dir))
+    save_metadata(metadata, os.path.join(output_dir, "metadata.jsonl"))
+    return metadata
+
+
+def run_workers(configs, num_workers):
+    # Spawned processes get a clean CUDA context and their own Runner
+    ctx = multiprocessing.get_context("spawn")
+    workers = [
+        ctx.Process(target=run, args=(configs, (index, num_workers)), name=shard_name(index))
+        for index in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Workers {', '.join(failed)} exited with errors")
+    return merge_metadata(configs)
 
 
 if __name__ == "__main__":
@@ -34,6 +121,30 @@ if __name__ == "__main__":
         help="Config file path for pipeline orchestration"
         "Config will be merged from left to right",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, sources are sharded across them",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only process shard i of N (formatted as i/N), e.g. one shard per machine",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the metadata of finished shards into the output directory",
+    )
     args = parser.parse_args()
 
-    run(args.config)
+    if args.merge:
+        merge_metadata(args.config)
+    elif exists(args.shard):
+        run(args.config, shard=args.shard)
+    elif args.workers > 1:
+        run_workers(args.config, args.workers)
+    else:
+        run(args.config)